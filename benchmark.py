@@ -0,0 +1,135 @@
+import argparse
+import json
+import multiprocessing
+import platform
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# End-to-end benchmark on seeded synthetic OMOP data: generate (or reuse) an
+# extract per scale, run load_data and train_models, and append the per-stage
+# report to a JSONL results file so runs are comparable across commits.
+#
+#   python benchmark.py --scales 10000 100000 1000000 --out benchmarks/results.jsonl
+
+DATA_DIR = Path("benchmarks") / "data"
+RESULTS = Path("benchmarks") / "results.jsonl"
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _versions():
+    import numpy, pandas, pyarrow, sklearn
+    return {
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "pandas": pandas.__version__,
+        "pyarrow": pyarrow.__version__,
+        "sklearn": sklearn.__version__,
+    }
+
+
+def run_scale(n_patients, seed, data_dir, streaming, skip_models, n_jobs, backend="pandas", check_backend=False,
+              models=("lr", "rf")):
+    # One scale, in its own process so peak RSS and imports don't carry over
+    from src.synthetic_data import generate_omop
+    from src.instrument import reset, report, stage
+    from src.load_data import load_data
+
+    folder = Path(data_dir).resolve() / f"omop_{n_patients}_seed{seed}"
+    generated = None
+    if not (folder / "measurement.parquet").exists():
+        with stage("generate_omop") as record:
+            generated = generate_omop(folder, n_patients, seed=seed)
+            record["rows_out"] = sum(generated.values())
+        generate_s = record["wall_s"]
+    else:
+        generate_s = None
+
+    reset()
+    df_features = load_data(folder, streaming=streaming, backend=backend)
+    stages = report()["stages"]
+    reset()
+
+    mismatched = None
+    if check_backend:
+        # Rebuild with the other backend and compare column for column
+        from src.arrow_backend import mismatched_columns
+        other = "pandas" if backend == "arrow" else "arrow"
+        mismatched = mismatched_columns(df_features, load_data(folder, backend=other))
+        print(f"{backend} vs {other}: {len(mismatched)} mismatched columns {mismatched[:10]}")
+
+    if not skip_models:
+        from models.train import train_models
+        reset()
+        train_models(df_features, models=models, n_jobs=n_jobs)
+        stages += report()["stages"]
+
+    input_bytes = sum(p.stat().st_size for p in folder.glob("*.parquet"))
+    return {
+        "generate_s": generate_s,
+        "generated_rows": generated,
+        "input_mb": round(input_bytes / 2**20, 1),
+        "feature_rows": len(df_features),
+        "feature_cols": df_features.shape[1],
+        "backend_mismatches": mismatched,
+        "stages": stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark on synthetic OMOP data")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=str(DATA_DIR))
+    parser.add_argument("--out", default=str(RESULTS))
+    parser.add_argument("--streaming", action="store_true", help="stream the measurement table")
+    parser.add_argument("--backend", choices=["pandas", "arrow"], default="pandas")
+    parser.add_argument("--check-backend", action="store_true", help="compare against the other backend")
+    parser.add_argument("--skip-models", action="store_true", help="features only, no training")
+    parser.add_argument("--models", nargs="+", default=["lr", "rf"], help="model types to train, e.g. lr rf hgb")
+    parser.add_argument("--n-jobs", type=int, default=None)
+    args = parser.parse_args()
+
+    out = Path(args.out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    commit, versions = _git_commit(), _versions()
+
+    for n_patients in args.scales:
+        print(f"=== {n_patients:,} patients ===")
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            result = pool.submit(
+                run_scale, n_patients, args.seed, args.data_dir, args.streaming, args.skip_models, args.n_jobs,
+                args.backend, args.check_backend, args.models
+            ).result()
+
+        total = next(s for s in result["stages"] if s["stage"] == "load_data")
+        print(f"load_data: {total['wall_s']:.1f}s, peak RSS {total['peak_rss_mb']:.0f} MB, "
+              f"{n_patients / total['wall_s']:,.0f} patients/s")
+
+        record = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": commit,
+            "n_patients": n_patients,
+            "seed": args.seed,
+            "streaming": args.streaming,
+            "backend": args.backend,
+            "models": None if args.skip_models else args.models,
+            "versions": versions,
+            **result,
+        }
+        with open(out, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+    print(f"Results appended to {out}")
+
+
+if __name__ == "__main__":
+    main()
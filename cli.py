@@ -0,0 +1,122 @@
+import argparse
+import os
+from dotenv import load_dotenv
+
+# Command-line entry point for running one step at a time from a scheduler:
+#
+#   python cli.py load       build (and cache) the cohort table
+#   python cli.py featurize  build the feature table and write it to --features
+#   python cli.py train      fit models on the feature table, save to --model-dir
+#   python cli.py score      score the feature table with the saved models
+#
+# Options default to the same .env settings as main.py. Only argparse and
+# dotenv are imported up front; pandas, pyarrow, scikit-learn and the
+# pipeline modules are imported inside the subcommand that needs them, so
+# e.g. `score` never loads the feature or training code: it imports pandas,
+# pyarrow and models.score (about 0.4 s), and scikit-learn only as the saved
+# pipelines are unpickled (about 1 s of its own, whatever the model).
+
+load_dotenv()
+
+
+def _require(args, *options):
+    # Options with an .env default can't be argparse-required; check here
+    missing = [f"--{o.replace('_', '-')}" for o in options if not getattr(args, o)]
+    if missing:
+        raise SystemExit(f"{args.command} needs {', '.join(missing)} (or the matching .env setting)")
+
+
+def _spec(args):
+    from src.spec import load_spec
+    return load_spec(args.spec)
+
+
+def load(args):
+    _require(args, "folder")
+    from src.load_data import load_data
+    df_cohort = load_data(args.folder, cache_dir=args.cache_dir, spec=_spec(args), cohort_only=True)
+    print(f"{len(df_cohort):,} patients, {int(df_cohort['event_status'].sum()):,} with an event")
+    if args.out:
+        df_cohort.to_parquet(args.out, index=False)
+
+
+def featurize(args):
+    _require(args, "folder", "features")
+    from src.load_data import load_data
+    from src.incremental import applied_deltas_path
+    df_features = load_data(args.folder, cache_dir=args.cache_dir, n_jobs=args.n_jobs or os.cpu_count(), spec=_spec(args))
+    # A fresh table for later deltas, as in main.py
+    df_features.to_parquet(args.features, index=False)
+    applied_deltas_path(args.features).unlink(missing_ok=True)
+    print(f"Wrote {len(df_features):,} rows x {df_features.shape[1]} columns to {args.features}")
+
+
+def train(args):
+    _require(args, "features")
+    import pandas as pd
+    from models.train import train_models
+    from models.survival import SURVIVAL_MODELS
+    spec = _spec(args)
+    df_features = pd.read_parquet(args.features)
+    params = None
+    if args.tune_dir:
+        from models.tune import tune_models
+        best = tune_models(df_features, models=spec["models"], horizons=list(spec["horizons"]), n_jobs=args.n_jobs,
+                           tune_dir=args.tune_dir)
+        params = {name: result["params"] for name, result in best.items()}
+    df_landmark = None
+    if set(spec["models"]) & set(SURVIVAL_MODELS):
+        # Survival models train on features rebuilt at each patient's landmark
+        _require(args, "folder")
+        from src.landmark import landmark_table
+        df_landmark = landmark_table(args.folder, df_features, spec=spec, cache_dir=args.cache_dir)
+    train_models(
+        df_features, models=spec["models"], horizons=list(spec["horizons"]), n_jobs=args.n_jobs,
+        model_dir=args.model_dir, params=params, matrix_dir=args.matrix_dir, df_landmark=df_landmark
+    )
+
+
+def score(args):
+    _require(args, "model_dir", "out", "matrix_dir" if args.matrix_dir else "features")
+    from models.score import Scorer
+    scorer = Scorer(args.model_dir)
+    if args.matrix_dir:
+        scores = scorer.score_matrix(os.path.join(args.matrix_dir, "design"))
+    else:
+        scores = scorer.score_parquet(args.features, person_ids=args.person_ids)
+    scores.to_parquet(args.out, index=False)
+    print(f"Wrote {len(scores):,} scores to {args.out}")
+
+
+def parser():
+    parser = argparse.ArgumentParser(description="Run one step of the pipeline")
+    parser.add_argument("--folder", default=os.getenv("FOLDER_PATH"), help="OMOP extract folder, relative to home")
+    parser.add_argument("--cache-dir", default=os.getenv("CACHE_DIR"))
+    parser.add_argument("--spec", default=os.getenv("FEATURE_SPEC"), help="JSON feature spec overrides")
+    parser.add_argument("--features", default=os.getenv("FEATURES_PATH"), help="feature table parquet")
+    parser.add_argument("--model-dir", default=os.getenv("MODEL_DIR"))
+    parser.add_argument("--matrix-dir", default=os.getenv("MATRIX_DIR"))
+    parser.add_argument("--n-jobs", type=int, default=int(os.getenv("N_JOBS", 0)) or None)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("load", help="build the cohort table")
+    cmd.add_argument("--out", help="also write the cohort to this parquet")
+    cmd.set_defaults(run=load)
+
+    cmd = commands.add_parser("featurize", help="build the feature table")
+    cmd.set_defaults(run=featurize)
+
+    cmd = commands.add_parser("train", help="fit and save the spec's models")
+    cmd.add_argument("--tune-dir", default=os.getenv("TUNE_DIR"), help="tune hyperparameters first, resuming from here")
+    cmd.set_defaults(run=train)
+
+    cmd = commands.add_parser("score", help="score the feature table with the saved models")
+    cmd.add_argument("--out", default=os.getenv("SCORES_PATH"), help="scores parquet")
+    cmd.add_argument("--person-ids", type=int, nargs="+", help="only these patients")
+    cmd.set_defaults(run=score)
+    return parser
+
+
+if __name__ == "__main__":
+    args = parser().parse_args()
+    args.run(args)
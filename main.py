@@ -1,19 +1,82 @@
-import pandas as pd
 import os
 from dotenv import load_dotenv
-from src.load_data import load_data
-from models.six_month_lr import six_month_lr
-from models.twelve_month_lr import twelve_month_lr
-from models.six_month_rf import six_month_rf
-from models.twelve_month_rf import twelve_month_rf
 
 load_dotenv()
 
 FOLDER_PATH = os.getenv("FOLDER_PATH")
+CACHE_DIR = os.getenv("CACHE_DIR")
+MODEL_DIR = os.getenv("MODEL_DIR")
+N_JOBS = int(os.getenv("N_JOBS", 0)) or None
+PIPELINE_REPORT = os.getenv("PIPELINE_REPORT")
+PROFILE_STAGE = os.getenv("PROFILE_STAGE")
+FEATURE_SPEC = os.getenv("FEATURE_SPEC")
+TUNE_DIR = os.getenv("TUNE_DIR")
+FEATURES_PATH = os.getenv("FEATURES_PATH")
+SCORES_PATH = os.getenv("SCORES_PATH")
+DELTA_PATH = os.getenv("DELTA_PATH")
+MATRIX_DIR = os.getenv("MATRIX_DIR")
 
-df_features = load_data(FOLDER_PATH)
+if __name__ == "__main__":
+    # Pipeline modules are imported here, and the training ones only on the
+    # path that trains, so a delta refresh doesn't load them (see also cli.py)
+    from src.instrument import enable_profiling, report
+    from src.spec import load_spec
+    from models.score import Scorer
 
-six_month_lr(df_features)
-twelve_month_lr(df_features)
-six_month_rf(df_features)
-twelve_month_rf(df_features)
\ No newline at end of file
+    if PROFILE_STAGE:
+        enable_profiling(PROFILE_STAGE, out_dir="profiles")
+
+    spec = load_spec(FEATURE_SPEC)
+
+    if DELTA_PATH:
+        from src.incremental import refresh_features
+        # Daily refresh: rebuild and rescore only the patients the delta
+        # touches, against the feature table and models of the last full run
+        df_new, person_ids = refresh_features(FOLDER_PATH, DELTA_PATH, FEATURES_PATH, spec=spec, cache_dir=CACHE_DIR)
+        if df_new is not None and SCORES_PATH:
+            Scorer(MODEL_DIR).update_scores(df_new, person_ids, SCORES_PATH)
+        if PIPELINE_REPORT:
+            report(PIPELINE_REPORT)
+        raise SystemExit
+
+    from src.load_data import load_data
+    from src.incremental import applied_deltas_path
+    from src.landmark import landmark_table
+    from models.train import train_models
+    from models.tune import tune_models
+    from models.survival import SURVIVAL_MODELS
+
+    # Lab and drug features on person-hashed shards across the same core budget
+    df_features = load_data(FOLDER_PATH, cache_dir=CACHE_DIR, n_jobs=N_JOBS or os.cpu_count(), spec=spec)
+    if FEATURES_PATH:
+        # The table later deltas are applied to; a full run starts it afresh
+        df_features.to_parquet(FEATURES_PATH, index=False)
+        applied_deltas_path(FEATURES_PATH).unlink(missing_ok=True)
+
+    # With TUNE_DIR, successive-halving search first (resumed from any results
+    # already there); the best hyperparameters are then used for training
+    params = None
+    if TUNE_DIR:
+        best = tune_models(df_features, models=spec["models"], horizons=list(spec["horizons"]), n_jobs=N_JOBS, tune_dir=TUNE_DIR)
+        params = {name: result["params"] for name, result in best.items()}
+
+    # Survival models train on features rebuilt at each patient's landmark
+    df_landmark = None
+    if set(spec["models"]) & set(SURVIVAL_MODELS):
+        df_landmark = landmark_table(FOLDER_PATH, df_features, spec=spec, cache_dir=CACHE_DIR)
+
+    # Every spec model for every horizon, run concurrently on a shared process
+    # pool; fitted pipelines are saved to MODEL_DIR for models/score.py and,
+    # with MATRIX_DIR, the memory-mapped design matrix is kept there
+    train_models(
+        df_features, models=spec["models"], horizons=list(spec["horizons"]), n_jobs=N_JOBS, model_dir=MODEL_DIR,
+        params=params, matrix_dir=MATRIX_DIR, df_landmark=df_landmark
+    )
+
+    if MODEL_DIR and SCORES_PATH:
+        scorer = Scorer(MODEL_DIR)
+        scores = scorer.score_matrix(f"{MATRIX_DIR}/design") if MATRIX_DIR else scorer.score(df_features)
+        scores.to_parquet(SCORES_PATH, index=False)
+
+    if PIPELINE_REPORT:
+        report(PIPELINE_REPORT)
@@ -0,0 +1,197 @@
+import numpy as np
+import json
+import joblib
+from pathlib import Path
+from src.windows import WINDOWS
+
+# scikit-learn and scipy are imported where they are used, so that scoring
+# (models/score.py) only loads what the saved models themselves need
+
+TARGET = "event_status"
+
+# IDs and dates that would leak the outcome
+ID_COLS = [
+    "person_id",
+    "death_date",
+    "first_activity_date",
+    "last_activity_date",
+    "last_of_death_or_visit",
+    "first_bone_event_date",
+    "T_ref",
+    "landmark_date",
+    "follow_up_days",
+]
+
+HORIZONS = list(WINDOWS)  # SPEC["horizons"] by default
+
+
+def _gender_binary(df):
+    return (
+        df["gender_concept_name"]
+        .astype(str)
+        .str.lower()
+        .map({"male": 1, "female": 0})
+    )
+
+
+def design_matrix(df, horizon, horizons=HORIZONS):
+    # Features for one horizon: drop IDs/leakage and every other horizon's
+    # window features (columns ending in _{horizon}), encode gender as binary.
+    # horizon=None keeps every horizon's features
+    other = [h for h in horizons if h != horizon] if horizon is not None else []
+    drop_cols = ID_COLS + [c for c in df.columns if any(c.endswith(f"_{h}") for h in other)]
+    drop_cols.append("gender_concept_name")
+
+    feature_cols = [c for c in df.columns if c not in drop_cols + [TARGET]]
+    X = df[feature_cols].assign(gender_binary=_gender_binary(df))
+    y = df[TARGET].astype(int).values
+    return X, y
+
+
+def sparse_design_matrix(df, lab_block, horizon, horizons=HORIZONS):
+    # design_matrix for load_data(sparse=True) output: the dense columns, then
+    # the horizon's lab columns (0 where unmeasured) and their observed masks
+    # ("{column}_observed"), as one float32 CSR matrix. Returns X, y and the
+    # feature column names
+    from scipy import sparse
+    X_dense, y = design_matrix(df, horizon, horizons)
+    keep = [i for i, c in enumerate(lab_block["columns"]) if c.endswith(f"_{horizon}")]
+    lab_cols = [lab_block["columns"][i] for i in keep]
+    X = sparse.hstack([
+        sparse.csr_matrix(X_dense.to_numpy(dtype=np.float32)),
+        lab_block["values"][:, keep],
+        lab_block["observed"][:, keep],
+    ], format="csr", dtype=np.float32)
+    return X, y, list(X_dense.columns) + lab_cols + [f"{c}_observed" for c in lab_cols]
+
+
+def for_sparse(model):
+    # Centring would densify a sparse matrix, so the scaler only scales
+    from sklearn.pipeline import Pipeline
+    if isinstance(model, Pipeline) and "scaler" in model.named_steps:
+        model.set_params(scaler__with_mean=False)
+    return model
+
+
+def encode_features(df, feature_cols):
+    # Rebuild a saved model's design matrix from a feature table; columns the
+    # table doesn't have come through as NaN and are imputed by the pipeline.
+    # Models trained on the sparse design get "{column}_observed" masks, read
+    # from which lab values are present (a table built with lab_fill_value
+    # null), with unmeasured values set to 0 as in training
+    if "gender_binary" in feature_cols and "gender_concept_name" in df.columns:
+        df = df.assign(gender_binary=_gender_binary(df))
+    masked = [c[:-len("_observed")] for c in feature_cols if c.endswith("_observed")]
+    masked = [c for c in masked if c in df.columns]
+    if masked:
+        observed = {f"{c}_observed": df[c].notna().astype(np.float32) for c in masked}
+        df = df.assign(**observed, **{c: df[c].fillna(0) for c in masked})
+    return df.reindex(columns=feature_cols)
+
+
+def split_indices(y):
+    # Same split as train_test_split(X, y, test_size=0.2, stratify=y, random_state=42)
+    from sklearn.model_selection import train_test_split
+    return train_test_split(
+        np.arange(len(y)),
+        test_size=0.2,
+        stratify=y,
+        random_state=42
+    )
+
+
+def cv_folds(y_train):
+    from sklearn.model_selection import StratifiedKFold
+    cv = StratifiedKFold(
+        n_splits=5,
+        shuffle=True,
+        random_state=42
+    )
+    return list(cv.split(np.zeros(len(y_train)), y_train))
+
+
+def _l1_ratio_sets_penalty():
+    # scikit-learn 1.8 picks L1 vs L2 from l1_ratio and deprecates penalty;
+    # before that l1_ratio is ignored unless penalty='elasticnet'
+    import sklearn
+    return tuple(int(v) for v in sklearn.__version__.split(".")[:2]) >= (1, 8)
+
+
+def lr_model(n_jobs=1, **params):
+    # Applied after median imputation; liblinear is single-threaded so n_jobs
+    # is unused. params override the LogisticRegression settings; l1_ratio
+    # (0 = L2, 1 = L1) is passed as penalty on scikit-learn before 1.8
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.linear_model import LogisticRegression
+    params = {"l1_ratio": 0.0, "solver": "liblinear", "max_iter": 1000, **params}
+    if not _l1_ratio_sets_penalty() and "penalty" not in params:
+        l1_ratio = params.pop("l1_ratio")
+        params["penalty"] = {0: "l2", 1: "l1"}.get(l1_ratio, "elasticnet")
+        if params["penalty"] == "elasticnet":
+            params["l1_ratio"] = l1_ratio
+    return Pipeline([
+        ("scaler", StandardScaler()),
+        ("model", LogisticRegression(**params))
+    ])
+
+
+def rf_model(n_jobs=-1, **params):
+    # Applied after median imputation; params override the forest settings
+    from sklearn.ensemble import RandomForestClassifier
+    return RandomForestClassifier(**{
+        "n_estimators": 500,
+        "max_depth": 6,
+        "min_samples_leaf": 20,
+        "max_features": "sqrt",
+        "class_weight": "balanced",
+        "random_state": 42,
+        "n_jobs": n_jobs,
+        **params
+    })
+
+
+def hgb_model(n_jobs=None, **params):
+    # Fit on the raw float32 matrix: NaNs go to whichever side of each split
+    # helps most, so there is no imputation step. Stops once the loss on an
+    # internal 10% validation split hasn't improved for 20 iterations. Uses
+    # OpenMP threads rather than n_jobs; callers cap them with threadpool_limits
+    from sklearn.ensemble import HistGradientBoostingClassifier
+    return HistGradientBoostingClassifier(**{
+        "max_iter": 500,
+        "learning_rate": 0.05,
+        "max_leaf_nodes": 31,
+        "min_samples_leaf": 20,
+        "l2_regularization": 1.0,
+        "early_stopping": True,
+        "validation_fraction": 0.1,
+        "n_iter_no_change": 20,
+        "random_state": 42,
+        **params
+    })
+
+
+MODELS = {
+    "lr": lr_model,
+    "rf": rf_model,
+    "hgb": hgb_model,
+}
+
+# Models that take missing values as-is instead of after median imputation
+NATIVE_MISSING = {"hgb"}
+
+
+def save_model(pipeline, feature_cols, name, model_dir):
+    # Fitted pipeline plus a manifest of the feature columns it expects, in order
+    model_dir = Path(model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    joblib.dump(pipeline, model_dir / f"{name}.joblib")
+    with open(model_dir / f"{name}.json", "w") as f:
+        json.dump({"name": name, "feature_columns": list(feature_cols)}, f, indent=2)
+
+
+def load_model(name, model_dir):
+    model_dir = Path(model_dir)
+    with open(model_dir / f"{name}.json") as f:
+        manifest = json.load(f)
+    return joblib.load(model_dir / f"{name}.joblib"), manifest["feature_columns"]
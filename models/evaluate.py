@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+from scipy.special import expit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Bootstrap confidence intervals for hold-out predictions. A bootstrap
+# replicate is a vector of resampling counts over the test rows, so a batch
+# of replicates is one (replicates x rows) count matrix and every metric is
+# computed for the whole batch with array operations: the rows are sorted by
+# score once, and AUC and average precision become cumulative sums of the
+# per-replicate counts over the distinct scores, in place of a sort per
+# replicate.
+
+METRICS = ["auc", "pr_auc", "brier", "calibration_in_the_large", "calibration_slope", "ece"]
+CALIBRATION_BINS = 10
+
+
+def _level_counts(counts, y_true, levels, n_levels):
+    # Per-replicate count of positives and negatives at each distinct score
+    # (levels ascending): two (replicates x n_levels) matrices, by one
+    # scatter-add over the flattened (replicate, level) index
+    n_replicates = counts.shape[0]
+    flat = (np.arange(n_replicates)[:, None] * n_levels + levels).ravel()
+    size = n_replicates * n_levels
+    pos = np.bincount(flat, weights=(counts * y_true).ravel(), minlength=size)
+    neg = np.bincount(flat, weights=(counts * (1 - y_true)).ravel(), minlength=size)
+    return pos.reshape(n_replicates, n_levels), neg.reshape(n_replicates, n_levels)
+
+
+def _weighted_loglik(beta, counts, y_true, x):
+    z = beta[:, :1] + beta[:, 1:] * x
+    return (counts * (y_true * z - np.logaddexp(0, z))).sum(axis=1)
+
+
+def _calibration_fit(counts, y_true, y_prob, n_iter=50, tol=1e-7, start=None):
+    # Weighted logistic regression of y on logit(p), one per replicate, by
+    # Newton steps on all replicates at once (halved per replicate until its
+    # likelihood improves; converged replicates drop out): (replicates x 2)
+    # intercepts and slopes. Starting from the fit on the unresampled rows
+    # (start) saves most iterations, as replicates land close to it
+    eps = 1e-7
+    x = np.log(np.clip(y_prob, eps, 1 - eps) / np.clip(1 - y_prob, eps, 1 - eps))
+    beta = np.zeros((counts.shape[0], 2))
+    beta[:, 1] = 1.0
+    if start is not None:
+        beta[:] = start
+    loglik = _weighted_loglik(beta, counts, y_true, x)
+    active = np.arange(counts.shape[0])
+    for _ in range(n_iter):
+        b, c, ll = beta[active], counts[active], loglik[active]
+        mu = expit(b[:, :1] + b[:, 1:] * x)
+        resid = c * (y_true - mu)
+        w = c * mu * (1 - mu)
+        grad = np.stack([resid.sum(axis=1), (resid * x).sum(axis=1)], axis=1)
+        h00, h01, h11 = w.sum(axis=1), (w * x).sum(axis=1), (w * x * x).sum(axis=1)
+        det = h00 * h11 - h01 ** 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            step = np.stack([(h11 * grad[:, 0] - h01 * grad[:, 1]) / det, (h00 * grad[:, 1] - h01 * grad[:, 0]) / det], axis=1)
+        step = np.where(np.isfinite(step), step, 0)
+        # Near the optimum rounding can make a full step look slightly worse;
+        # that is not a reason to halve it
+        floor = ll - 1e-9 * np.abs(ll)
+        for _ in range(30):
+            new_ll = _weighted_loglik(b + step, c, y_true, x)
+            worse = new_ll < floor
+            if not worse.any():
+                break
+            step[worse] /= 2
+        step[new_ll < floor] = 0
+        beta[active], loglik[active] = b + step, np.maximum(new_ll, ll)
+        active = active[np.abs(step).max(axis=1) >= tol]
+        if not len(active):
+            break
+    return beta
+
+
+def batch_metrics(counts, y_true, y_prob, calibration_start=None):
+    # Every METRICS value for each row of counts (how many times each test
+    # row is drawn in that replicate): {metric: array of len(counts)}.
+    # Replicates without both classes get NaN for AUC and slope.
+    # calibration_start is passed on to _calibration_fit
+    counts = np.asarray(counts, dtype=float)
+    y_true = np.asarray(y_true).astype(float)
+    y_prob = np.asarray(y_prob, dtype=float)
+    n = counts.sum(axis=1)
+
+    uniques, levels = np.unique(y_prob, return_inverse=True)
+    pos, neg = _level_counts(counts, y_true, levels, len(uniques))
+    n_pos, n_neg = pos.sum(axis=1), neg.sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # AUC: each positive beats the negatives below its score, ties count half
+        neg_below = np.cumsum(neg, axis=1) - neg
+        auc = (pos * (neg_below + 0.5 * neg)).sum(axis=1) / (n_pos * n_neg)
+        auc[(n_pos == 0) | (n_neg == 0)] = np.nan
+
+        # Average precision (sklearn's step-wise PR-AUC): precision at each
+        # threshold, from the highest score down, weighted by the recall gained
+        tp = np.cumsum(pos[:, ::-1], axis=1)
+        fp = np.cumsum(neg[:, ::-1], axis=1)
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0)
+        pr_auc = (pos[:, ::-1] * precision).sum(axis=1) / n_pos
+
+        brier = counts @ (y_prob - y_true) ** 2 / n
+        citl = (counts @ y_prob - counts @ y_true) / n
+
+        # Expected calibration error over equal-width probability bins
+        bins = np.minimum((y_prob * CALIBRATION_BINS).astype(int), CALIBRATION_BINS - 1)
+        onehot = np.zeros((len(y_prob), CALIBRATION_BINS))
+        onehot[np.arange(len(y_prob)), bins] = 1
+        ece = np.abs(counts @ (onehot * y_prob[:, None]) - counts @ (onehot * y_true[:, None])).sum(axis=1) / n
+
+    slope = _calibration_fit(counts, y_true, y_prob, start=calibration_start)[:, 1]
+    slope[(n_pos == 0) | (n_neg == 0)] = np.nan
+    return {
+        "auc": auc, "pr_auc": pr_auc, "brier": brier,
+        "calibration_in_the_large": citl, "calibration_slope": slope, "ece": ece,
+    }
+
+
+def _bootstrap_batch(y_true, y_prob, n_replicates, seed, calibration_start=None):
+    # Resampling counts for n_replicates replicates, drawn as multinomials
+    # (the same distribution as sampling rows with replacement)
+    rng = np.random.default_rng(seed)
+    n = len(y_true)
+    counts = rng.multinomial(n, np.full(n, 1 / n), size=n_replicates)
+    return batch_metrics(counts, y_true, y_prob, calibration_start)
+
+
+def bootstrap_metrics(y_true, y_prob, n_boot=2000, alpha=0.05, seed=42, n_jobs=1, batch_size=250):
+    # Point estimates and percentile bootstrap CIs for METRICS on a test set:
+    # one row per metric with estimate, ci_lower, ci_upper. Replicates are
+    # computed batch_size at a time (bounding memory at batch_size x rows),
+    # batches optionally on n_jobs processes. Each batch has its own seed, so
+    # results don't depend on n_jobs
+    y_true, y_prob = np.asarray(y_true), np.asarray(y_prob, dtype=float)
+    sizes = [min(batch_size, n_boot - start) for start in range(0, n_boot, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    ones = np.ones((1, len(y_true)))
+    estimate = batch_metrics(ones, y_true, y_prob)
+    start = _calibration_fit(ones, y_true.astype(float), y_prob)[0]
+
+    if n_jobs is not None and n_jobs > 1 and len(sizes) > 1:
+        context = multiprocessing.get_context("forkserver")
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(sizes)), mp_context=context) as pool:
+            batches = list(pool.map(
+                _bootstrap_batch, [y_true] * len(sizes), [y_prob] * len(sizes), sizes, seeds, [start] * len(sizes)
+            ))
+    else:
+        batches = [_bootstrap_batch(y_true, y_prob, size, s, start) for size, s in zip(sizes, seeds)]
+
+    rows = []
+    for metric in METRICS:
+        replicates = np.concatenate([batch[metric] for batch in batches])
+        lower, upper = np.nanpercentile(replicates, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+        rows.append({"metric": metric, "estimate": estimate[metric][0], "ci_lower": lower, "ci_upper": upper})
+    return pd.DataFrame(rows).set_index("metric")
@@ -0,0 +1,101 @@
+import json
+import numpy as np
+from pathlib import Path
+from models.common import HORIZONS, TARGET, design_matrix
+
+# Design matrices on disk. The feature table's design matrix (every horizon's
+# features) is written once as a float32 .npy with a JSON manifest of its
+# columns, and the imputed train/eval arrays of every CV split are written
+# the same way. Workers open them with np.load(mmap_mode="r") instead of
+# receiving pickled copies, so they all read the same page-cache pages and
+# memory doesn't grow with the number of workers. Arrays are C-contiguous
+# float32, which the forests and gradient boosting use without copying.
+
+
+def save_array(X, path):
+    # One array at path (without suffix): dense as path.npy; CSR as its
+    # data/indices/indptr .npy files plus path.json with the shape
+    from scipy import sparse
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if sparse.issparse(X):
+        X = sparse.csr_matrix(X)
+        for part in ("data", "indices", "indptr"):
+            np.save(path.with_name(f"{path.name}.{part}.npy"), getattr(X, part))
+        path.with_name(f"{path.name}.json").write_text(json.dumps({"shape": list(X.shape)}))
+    else:
+        np.save(path.with_name(f"{path.name}.npy"), np.ascontiguousarray(X))
+    return path
+
+
+def load_array(path):
+    # save_array's array, memory-mapped read-only
+    path = Path(path)
+    shape_path = path.with_name(f"{path.name}.json")
+    if shape_path.exists():
+        from scipy import sparse
+        parts = [np.load(path.with_name(f"{path.name}.{part}.npy"), mmap_mode="r") for part in ("data", "indices", "indptr")]
+        return sparse.csr_matrix(tuple(parts), shape=tuple(json.loads(shape_path.read_text())["shape"]), copy=False)
+    return np.load(path.with_name(f"{path.name}.npy"), mmap_mode="r")
+
+
+def write_design_matrix(df, matrix_dir, horizons=HORIZONS):
+    # design_matrix with every horizon's features, as matrix_dir/X.npy
+    # (float32) with y.npy, person_id.npy and manifest.json (columns, in order)
+    matrix_dir = Path(matrix_dir)
+    matrix_dir.mkdir(parents=True, exist_ok=True)
+    X, y = design_matrix(df, None, horizons)
+    save_array(X.to_numpy(dtype=np.float32), matrix_dir / "X")
+    np.save(matrix_dir / "y.npy", y)
+    np.save(matrix_dir / "person_id.npy", df["person_id"].to_numpy())
+    manifest = {"columns": list(X.columns), "target": TARGET, "horizons": list(horizons), "n_rows": len(X)}
+    (matrix_dir / "manifest.json").write_text(json.dumps(manifest, indent=2))
+    return matrix_dir
+
+
+def open_design_matrix(matrix_dir):
+    # (X memory-mapped read-only, y, person_id, columns) from write_design_matrix
+    matrix_dir = Path(matrix_dir)
+    manifest = json.loads((matrix_dir / "manifest.json").read_text())
+    return (
+        load_array(matrix_dir / "X"), np.load(matrix_dir / "y.npy"), np.load(matrix_dir / "person_id.npy"),
+        manifest["columns"]
+    )
+
+
+def horizon_columns(columns, horizon, horizons=HORIZONS):
+    # Positions of one horizon's features among the design matrix columns
+    # (what design_matrix(df, horizon) keeps)
+    other = [h for h in horizons if h != horizon]
+    return [i for i, c in enumerate(columns) if not any(c.endswith(f"_{h}") for h in other)]
+
+
+def store_splits(splits, split_dir):
+    # Write prepare_horizon's splits under split_dir:
+    # {split_name: (X_fit, X_eval, y_fit, y_eval) paths} for load_split
+    split_dir = Path(split_dir)
+    parts = ("X_fit", "X_eval", "y_fit", "y_eval")
+    return {
+        name: tuple(save_array(array, split_dir / f"{name}_{part}") for part, array in zip(parts, arrays))
+        for name, arrays in splits.items()
+    }
+
+
+def load_split(paths):
+    return tuple(load_array(path) for path in paths)
+
+
+def matrix_features(X, columns, feature_cols):
+    # encode_features for rows of a stored design matrix: a saved model's
+    # feature_cols in order, NaN for columns the matrix doesn't have, and
+    # "{column}_observed" masks read from which values are present
+    position = {c: i for i, c in enumerate(columns)}
+    out = np.full((X.shape[0], len(feature_cols)), np.nan, dtype=np.float32)
+    for j, c in enumerate(feature_cols):
+        if c in position:
+            out[:, j] = X[:, position[c]]
+        elif c.endswith("_observed") and c[:-len("_observed")] in position:
+            out[:, j] = ~np.isnan(X[:, position[c[:-len("_observed")]]])
+    masked = [j for j, c in enumerate(feature_cols) if f"{c}_observed" in feature_cols]
+    out[:, masked] = np.nan_to_num(out[:, masked], nan=0.0)
+    return out
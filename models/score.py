@@ -0,0 +1,106 @@
+import pandas as pd
+import numpy as np
+from pathlib import Path
+from src.parquet_scan import iter_batches
+from models.common import encode_features, load_model
+from models.matrix import open_design_matrix, matrix_features
+
+
+class Scorer:
+    # Loads saved pipelines once (see save_model) and scores feature tables
+    # with them. Output has person_id plus one risk_{horizon}_{model} column
+    # per loaded model, e.g. risk_6m_lr, risk_12m_rf.
+
+    def __init__(self, model_dir, names=None):
+        model_dir = Path(model_dir)
+        if names is None:
+            names = sorted(p.stem for p in model_dir.glob("*.json"))
+        if not names:
+            raise FileNotFoundError(f"No saved models in {model_dir}")
+
+        self.models = {}
+        for name in names:
+            pipeline, feature_cols = load_model(name, model_dir)
+            # Scoring is called from many small requests; don't fan out threads
+            if "model__n_jobs" in pipeline.get_params():
+                pipeline.set_params(model__n_jobs=1)
+            model, horizon = name.rsplit("_", 1)
+            self.models[f"risk_{horizon}_{model}"] = (pipeline, feature_cols)
+
+        self.columns = sorted({c for _, cols in self.models.values() for c in cols} | {"gender_concept_name"})
+
+    def score(self, df_features):
+        out = {"person_id": df_features["person_id"].to_numpy()}
+        for column, (pipeline, feature_cols) in self.models.items():
+            X = encode_features(df_features, feature_cols)
+            # Pipelines from models/train.py were fit on arrays, not frames
+            if not hasattr(pipeline, "feature_names_in_"):
+                X = np.ascontiguousarray(X.to_numpy(dtype=np.float32))
+            out[column] = pipeline.predict_proba(X)[:, 1]
+        return pd.DataFrame(out)
+
+    def score_one(self, features):
+        # Single patient given as a dict of feature values; skips building a
+        # DataFrame so the cost is the models' own predict calls
+        features = dict(features)
+        if "gender_concept_name" in features:
+            features["gender_binary"] = {"male": 1, "female": 0}.get(str(features["gender_concept_name"]).lower(), np.nan)
+
+        out = {"person_id": features.get("person_id")}
+        for column, (pipeline, feature_cols) in self.models.items():
+            X = np.array([[features.get(c, np.nan) for c in feature_cols]], dtype=float)
+            if hasattr(pipeline, "feature_names_in_"):
+                X = pd.DataFrame(X, columns=feature_cols)
+            out[column] = float(pipeline.predict_proba(X)[0, 1])
+        return out
+
+    def score_matrix(self, matrix_dir, batch_size=100_000):
+        # Score the design matrix train_models stored in matrix_dir/design
+        # (see models/matrix.py) straight from its memory map, batch_size
+        # rows at a time, without loading the feature table
+        X_all, _, person_ids, columns = open_design_matrix(matrix_dir)
+        parts = []
+        for start in range(0, len(person_ids), batch_size):
+            rows = X_all[start:start + batch_size]
+            out = {"person_id": person_ids[start:start + batch_size]}
+            for column, (pipeline, feature_cols) in self.models.items():
+                X = matrix_features(rows, columns, feature_cols)
+                if hasattr(pipeline, "feature_names_in_"):
+                    X = pd.DataFrame(X, columns=feature_cols)
+                out[column] = pipeline.predict_proba(X)[:, 1]
+            parts.append(pd.DataFrame(out))
+        if not parts:
+            return pd.DataFrame(columns=["person_id"] + list(self.models))
+        return pd.concat(parts, ignore_index=True)
+
+    def update_scores(self, df_features, person_ids, scores_path):
+        # Rescore only the patients refreshed by src/incremental.py: the
+        # scores of person_ids in the scores parquet are replaced by scores
+        # of their rebuilt rows in df_features (patients who left the cohort
+        # have none and are dropped). Returns the new scores
+        scores = self.score(df_features)
+        scores_path = Path(scores_path)
+        if scores_path.exists():
+            previous = pd.read_parquet(scores_path)
+            previous = previous[~previous["person_id"].isin(person_ids)]
+            scores_all = pd.concat([previous, scores], ignore_index=True).sort_values("person_id", kind="stable")
+        else:
+            scores_all = scores
+        scores_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = scores_path.with_suffix(".tmp")
+        scores_all.to_parquet(tmp, index=False)
+        tmp.replace(scores_path)
+        return scores
+
+    def score_parquet(self, features_path, person_ids=None, batch_size=100_000):
+        # Score a feature parquet (e.g. the feature store's features table) in
+        # batches so memory stays bounded; optionally only the given person_ids
+        filters = [("person_id", "in", np.asarray(person_ids))] if person_ids is not None else None
+        columns = ["person_id"] + self.columns
+        parts = [
+            self.score(batch)
+            for batch in iter_batches(features_path, columns, filters, batch_size)
+        ]
+        if not parts:
+            return pd.DataFrame(columns=["person_id"] + list(self.models))
+        return pd.concat(parts, ignore_index=True)
@@ -0,0 +1,226 @@
+import re
+import copy
+import numpy as np
+from sklearn.base import BaseEstimator
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from src.instrument import instrumented
+from models.common import HORIZONS, design_matrix, split_indices, cv_folds, save_model
+
+# Time-to-event models: one model on every horizon's features instead of one
+# classifier per horizon, fit on src/landmark.py's table: follow-up from each
+# patient's landmark to T_ref with event_status as event vs censored, and
+# covariates from before the landmark. Risk at each horizon (6m = 6 months
+# after the landmark) is read off the same fitted survival curve. The
+# evaluation imports are inside train_survival, so unpickling a saved model
+# for scoring doesn't load them.
+
+DAYS_PER_MONTH = 365.25 / 12
+
+
+def horizon_days(horizon):
+    # "6m" -> days in 6 months
+    match = re.fullmatch(r"(\d+)m", horizon)
+    if match is None:
+        raise ValueError(f"Can't read a duration from horizon {horizon!r}; expected e.g. '6m'")
+    return int(match.group(1)) * DAYS_PER_MONTH
+
+
+def survival_data(df_landmark, horizons=HORIZONS):
+    # Design matrix with every horizon's window features, follow-up days from
+    # the landmark, and events
+    X, events = design_matrix(df_landmark, None, horizons)
+    durations = df_landmark["follow_up_days"].to_numpy(dtype=float)
+    return X, durations, events
+
+
+def horizon_labels(durations, events, days):
+    # Event within days of the landmark, and whether that is known: patients
+    # censored before then are left out
+    y = events.astype(bool) & (durations <= days)
+    return y, y | (durations > days)
+
+
+class CoxPH(BaseEstimator):
+    # Cox proportional hazards with a ridge penalty (alpha), fit by Newton's
+    # method on the Breslow partial likelihood. Each iteration is a few
+    # matrix products over all patients: risk-set sums are reverse cumulative
+    # sums over patients sorted by follow-up time, and the Hessian's risk-set
+    # second moments collapse to one weighted X'X, so nothing loops over
+    # event times or builds per-time p x p matrices.
+    #
+    # predict_proba gives [1 - risk, risk] of an event within `time` days, so
+    # one fitted model set to each horizon's days works wherever the
+    # classifiers do (Pipeline, save_model, Scorer).
+
+    def __init__(self, alpha=1.0, time=365.25, max_iter=100, tol=1e-9):
+        self.alpha = alpha
+        self.time = time
+        self.max_iter = max_iter
+        self.tol = tol
+
+    def _risk_sets(self, eta):
+        # Per event time: log of the risk-set sum of exp(eta), and the
+        # risk-set mean of X; exp is shifted by max(eta) against overflow
+        shift = eta.max()
+        w = np.exp(eta - shift)
+        s0 = np.cumsum(w[::-1])[::-1][self._first]
+        s1 = np.cumsum((w[:, None] * self._X)[::-1], axis=0)[::-1][self._first]
+        return np.log(s0) + shift, s1 / s0[:, None], w, s0
+
+    def _loglik(self, beta):
+        eta = self._X @ beta
+        log_s0 = self._risk_sets(eta)[0]
+        return eta[self._events].sum() - self._deaths @ log_s0 - 0.5 * self.alpha * beta @ beta
+
+    def fit(self, X, y, durations):
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y).astype(bool)
+        durations = np.asarray(durations, dtype=float)
+
+        # Sort by follow-up time; each event time's risk set is everyone from
+        # the first patient with that time onwards
+        order = np.argsort(durations, kind="stable")
+        self._X, self._events, times = X[order], y[order], durations[order]
+        self.event_times_, self._deaths = np.unique(times[self._events], return_counts=True)
+        self._first = np.searchsorted(times, self.event_times_, side="left")
+        # Event times at or before each patient's own time (patient in those risk sets)
+        at_risk_until = np.searchsorted(self.event_times_, times, side="right")
+
+        beta = np.zeros(X.shape[1])
+        loglik = self._loglik(beta)
+        for self.n_iter_ in range(1, self.max_iter + 1):
+            eta = self._X @ beta
+            log_s0, mean_x, w, s0 = self._risk_sets(eta)
+            grad = self._X[self._events].sum(axis=0) - self._deaths @ mean_x - self.alpha * beta
+
+            # sum_k d_k * E_k[x x'] = X' diag(w_i * sum_{k: i at risk} d_k / s0_k) X
+            hazard_steps = np.concatenate([[0.0], np.cumsum(self._deaths / s0)])
+            weights = w * hazard_steps[at_risk_until]
+            hessian = (self._X * weights[:, None]).T @ self._X - (mean_x * self._deaths[:, None]).T @ mean_x
+            hessian[np.diag_indices_from(hessian)] += self.alpha
+            step = np.linalg.solve(hessian, grad)
+
+            # Halve the step until the penalized likelihood improves
+            for _ in range(30):
+                new_loglik = self._loglik(beta + step)
+                if new_loglik >= loglik:
+                    break
+                step /= 2
+            beta, change = beta + step, new_loglik - loglik
+            loglik = new_loglik
+            if abs(change) <= self.tol * (abs(loglik) + 1):
+                break
+
+        self.coef_ = beta
+        self.log_likelihood_ = loglik
+        # Breslow baseline cumulative hazard at each event time
+        log_s0 = self._risk_sets(self._X @ beta)[0]
+        self.cumulative_hazard_ = np.cumsum(self._deaths * np.exp(-log_s0))
+        self.classes_ = np.array([0, 1])
+        del self._X, self._events, self._deaths, self._first
+        return self
+
+    def predict(self, X):
+        # Linear predictor (log relative hazard)
+        return np.asarray(X, dtype=float) @ self.coef_
+
+    def predict_risk(self, X, times):
+        # P(event by t) for each row and each t in times: (rows, len(times))
+        idx = np.searchsorted(self.event_times_, np.atleast_1d(times), side="right") - 1
+        baseline = np.where(idx >= 0, self.cumulative_hazard_[np.maximum(idx, 0)], 0.0)
+        return 1 - np.exp(-np.exp(self.predict(X))[:, None] * baseline[None, :])
+
+    def predict_proba(self, X):
+        risk = self.predict_risk(X, [self.time])[:, 0]
+        return np.column_stack([1 - risk, risk])
+
+
+def cox_model(**params):
+    # Median imputation and scaling as for lr, so the ridge penalty treats
+    # every feature alike
+    return Pipeline([
+        ("imputer", SimpleImputer(strategy="median")),
+        ("scaler", StandardScaler()),
+        ("model", CoxPH(**params)),
+    ])
+
+
+SURVIVAL_MODELS = {
+    "cox": cox_model,
+}
+
+
+def concordance_index(durations, risk, events, chunk=1024):
+    # Harrell's C: over pairs where the earlier time is an event, the share
+    # in which that patient has the higher risk (ties in risk count half).
+    # Compared a block of events at a time against everyone
+    durations, risk, events = np.asarray(durations), np.asarray(risk), np.asarray(events).astype(bool)
+    event_idx = np.flatnonzero(events)
+    concordant = comparable = 0.0
+    for start in range(0, len(event_idx), chunk):
+        i = event_idx[start:start + chunk]
+        pairs = durations[None, :] > durations[i, None]
+        comparable += pairs.sum()
+        concordant += (pairs & (risk[None, :] < risk[i, None])).sum() + 0.5 * (pairs & (risk[None, :] == risk[i, None])).sum()
+    return concordant / comparable if comparable else np.nan
+
+
+@instrumented()
+def train_survival(df_landmark, model_name="cox", horizons=HORIZONS, model_dir=None, params=None, n_boot=2000):
+    # One survival model for all horizons on the landmark table: 5-fold CV
+    # concordance on the training split, then a fit on the full training
+    # split scored on the hold-out set by concordance and, per horizon, AUC
+    # (with bootstrap CIs) of the risk by that horizon against an event by
+    # then, among hold-out patients not censored before it. Saved as one
+    # "{model_name}_{horizon}" pipeline per horizon, differing only in the
+    # time their predict_proba reads the risk at
+    from sklearn.metrics import roc_auc_score
+    from models.evaluate import bootstrap_metrics
+    X, durations, events = survival_data(df_landmark, horizons)
+    feature_cols = list(X.columns)
+    X = np.ascontiguousarray(X.to_numpy(dtype=np.float32))
+    train_idx, test_idx = split_indices(events)
+
+    cv_c = []
+    for fit_idx, eval_idx in cv_folds(events[train_idx]):
+        fit_idx, eval_idx = train_idx[fit_idx], train_idx[eval_idx]
+        pipeline = SURVIVAL_MODELS[model_name](**(params or {}))
+        pipeline.fit(X[fit_idx], events[fit_idx], model__durations=durations[fit_idx])
+        cv_c.append(concordance_index(durations[eval_idx], pipeline.predict(X[eval_idx]), events[eval_idx]))
+    cv_c = np.array(cv_c)
+
+    pipeline = SURVIVAL_MODELS[model_name](**(params or {}))
+    pipeline.fit(X[train_idx], events[train_idx], model__durations=durations[train_idx])
+    test_c = concordance_index(durations[test_idx], pipeline.predict(X[test_idx]), events[test_idx])
+
+    print(f"=== {model_name} (all horizons) ===")
+    print("CV concordance per fold:", cv_c)
+    print("Mean CV concordance:", cv_c.mean())
+    print("Hold-out concordance:", test_c)
+
+    days = [horizon_days(h) for h in horizons]
+    risk = pipeline[-1].predict_risk(pipeline[:-1].transform(X[test_idx]), days)
+
+    results = {}
+    for i, horizon in enumerate(horizons):
+        y_test, known = horizon_labels(durations[test_idx], events[test_idx], days[i])
+        y_test, y_prob = y_test[known].astype(int), risk[known, i]
+        test_auc = roc_auc_score(y_test, y_prob) if 0 < y_test.sum() < len(y_test) else np.nan
+        print(f"=== {model_name} {horizon} ({days[i]:.0f} days, {known.sum():,} hold-out patients, {y_test.sum():,} events) ===")
+        print("Hold-out test AUC:", test_auc)
+        evaluation = None
+        if n_boot and not np.isnan(test_auc):
+            evaluation = bootstrap_metrics(y_test, y_prob, n_boot=n_boot)
+            print(f"Hold-out metrics with 95% bootstrap CI ({n_boot} replicates):")
+            print(evaluation.round(4).to_string())
+
+        horizon_pipeline = copy.deepcopy(pipeline).set_params(model__time=days[i])
+        if model_dir is not None:
+            save_model(horizon_pipeline, feature_cols, f"{model_name}_{horizon}", model_dir)
+        results[(model_name, horizon)] = {
+            "cv_concordance": cv_c, "test_concordance": test_c, "test_auc": test_auc,
+            "evaluation": evaluation, "pipeline": horizon_pipeline,
+        }
+    return results
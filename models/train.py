@@ -0,0 +1,220 @@
+import os
+import tempfile
+import numpy as np
+from pathlib import Path
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.model_selection import cross_val_score
+from sklearn.metrics import roc_auc_score
+from threadpoolctl import threadpool_limits
+from src.instrument import instrumented
+from models.evaluate import bootstrap_metrics
+from models.survival import SURVIVAL_MODELS, train_survival
+from models.matrix import write_design_matrix, open_design_matrix, horizon_columns, store_splits, load_split
+from scipy import sparse
+from models.common import (
+    HORIZONS, MODELS, NATIVE_MISSING, design_matrix, sparse_design_matrix, for_sparse, split_indices, cv_folds, save_model
+)
+
+# Rough relative cost, so the slow forests are queued first
+MODEL_COST = {"rf": 10, "hgb": 3, "lr": 1}
+
+
+def _impute(X_fit, X_apply):
+    imputer = SimpleImputer(strategy="median").fit(X_fit)
+    return imputer.transform(X_fit), imputer.transform(X_apply), imputer
+
+
+def _no_impute(X_fit, X_apply):
+    return X_fit, X_apply, None
+
+
+@instrumented()
+def prepare_horizon(df, horizon, horizons=HORIZONS, impute=True, lab_block=None, matrix_dir=None):
+    # Design matrix, split and median imputation for one horizon, computed once
+    # and shared by every model: {split_name: (X_fit, X_eval, y_fit, y_eval)}.
+    # "fold0".."fold4" are the CV folds of the training set, "holdout" is the
+    # full training set against the test set. Also returns the feature columns
+    # and the hold-out imputer, for the saved pipelines. The matrix is one
+    # contiguous float32 block, which the forests use as-is. With impute=False
+    # the splits keep their NaNs (for NATIVE_MISSING models) and the imputer is
+    # None. With a lab_block from load_data(sparse=True) the matrix is CSR
+    # (see sparse_design_matrix) and the imputer only fills stored NaNs. With
+    # matrix_dir (from write_design_matrix) the horizon's columns are read
+    # from the stored design matrix rather than built from df
+    _impute_split = _impute if impute else _no_impute
+    if matrix_dir is not None:
+        X_all, y, _, columns = open_design_matrix(matrix_dir)
+        keep = horizon_columns(columns, horizon, horizons)
+        X, feature_cols = np.ascontiguousarray(X_all[:, keep]), [columns[i] for i in keep]
+    elif lab_block is not None:
+        X, y, feature_cols = sparse_design_matrix(df, lab_block, horizon, horizons)
+    else:
+        X, y = design_matrix(df, horizon, horizons)
+        feature_cols = list(X.columns)
+        X = np.ascontiguousarray(X.to_numpy(dtype=np.float32))
+
+    train_idx, test_idx = split_indices(y)
+    X_train, y_train = X[train_idx], y[train_idx]
+
+    splits = {}
+    for i, (fit_idx, eval_idx) in enumerate(cv_folds(y_train)):
+        X_fit, X_eval, _ = _impute_split(X_train[fit_idx], X_train[eval_idx])
+        splits[f"fold{i}"] = (X_fit, X_eval, y_train[fit_idx], y_train[eval_idx])
+    X_fit, X_eval, imputer = _impute_split(X_train, X[test_idx])
+    splits["holdout"] = (X_fit, X_eval, y_train, y[test_idx])
+    return splits, feature_cols, imputer
+
+
+def _fit_and_score(model_name, n_jobs, keep_model, split_paths, params=None):
+    # The split's arrays are memory-mapped from store_splits' files, not
+    # pickled over from the parent
+    X_fit, X_eval, y_fit, y_eval = load_split(split_paths)
+    model = MODELS[model_name](n_jobs=n_jobs, **(params or {}))
+    if sparse.issparse(X_fit):
+        model = for_sparse(model)
+    # Also caps OpenMP threads (hgb) at the task's share of the core budget
+    with threadpool_limits(limits=n_jobs):
+        model.fit(X_fit, y_fit)
+        y_prob = model.predict_proba(X_eval)[:, 1]
+    # The hold-out fit also returns its test-set probabilities, for bootstrap_metrics
+    return roc_auc_score(y_eval, y_prob), (model, y_prob) if keep_model else None
+
+
+@instrumented()
+def train_models(df, models=("lr", "rf"), horizons=HORIZONS, n_jobs=None, model_dir=None, params=None, lab_block=None,
+                 n_boot=2000, matrix_dir=None, df_landmark=None):
+    # Run the model x horizon x fold grid on a process pool. n_jobs is the total
+    # core budget (default: all cores); it is split between pool workers and the
+    # forests' own threads so the two don't oversubscribe the machine.
+    # Returns AUCs and the fitted hold-out pipelines; with model_dir they are
+    # also saved for models/score.py. params maps "{model}_{horizon}" to
+    # hyperparameter overrides, e.g. the best_params from models/tune.py.
+    # lab_block (from load_data(sparse=True)) trains on the sparse design.
+    # Hold-out AUC, PR-AUC, Brier score and calibration get n_boot-replicate
+    # bootstrap CIs (see models/evaluate.py); n_boot=0 skips them. Survival
+    # models (models/survival.py) are fit once for all horizons, before the
+    # grid, on df_landmark (src/landmark.py's table for df).
+    # The design matrix and every split are written to disk and memory-mapped
+    # by the workers (see models/matrix.py); with matrix_dir the design matrix
+    # is kept in matrix_dir/design for Scorer.score_matrix, otherwise all of it
+    # goes in a temporary directory
+    dense_only = (NATIVE_MISSING | set(SURVIVAL_MODELS)) & set(models)
+    if lab_block is not None and dense_only:
+        raise ValueError(f"{sorted(dense_only)} need the dense design matrix; drop lab_block")
+    params = params or {}
+    survival = [model for model in models if model in SURVIVAL_MODELS]
+    if survival and df_landmark is None:
+        raise ValueError(f"{survival} train on the landmark table; pass df_landmark=landmark_table(...)")
+    models = [model for model in models if model not in SURVIVAL_MODELS]
+    results = {}
+    for model in survival:
+        results.update(train_survival(df_landmark, model, horizons, model_dir, params.get(model), n_boot))
+    if not models:
+        return results
+
+    if matrix_dir is not None:
+        Path(matrix_dir).mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="splits-", dir=matrix_dir) as split_root:
+        design_dir = None
+        if lab_block is None:
+            design_dir = write_design_matrix(df, Path(matrix_dir or split_root) / "design", horizons)
+        results.update(_train_grid(
+            df, models, horizons, n_jobs, model_dir, params, lab_block, n_boot, design_dir, Path(split_root)
+        ))
+    return results
+
+
+def _train_grid(df, models, horizons, n_jobs, model_dir, params, lab_block, n_boot, design_dir, split_root):
+    budget = n_jobs or os.cpu_count()
+    # Imputed splits for lr/rf, raw splits for NATIVE_MISSING models; each
+    # only if some requested model needs it. Each is written out as soon as
+    # it is prepared, so only one horizon's splits are in memory at a time
+    prepared, feature_cols, imputers = {}, {}, {}
+    for horizon in horizons:
+        for impute in {model not in NATIVE_MISSING for model in models}:
+            key = (horizon, impute)
+            splits, feature_cols[horizon], imputers[key] = prepare_horizon(
+                df, horizon, horizons, impute, lab_block, design_dir
+            )
+            prepared[key] = store_splits(splits, split_root / f"{horizon}_{'imputed' if impute else 'raw'}")
+            del splits
+
+    def split_paths(model, horizon, split):
+        return prepared[(horizon, model not in NATIVE_MISSING)][split]
+
+    split_names = list(next(iter(prepared.values())))
+    tasks = [(model, horizon, split) for horizon in horizons for model in models for split in split_names]
+    tasks.sort(key=lambda task: -MODEL_COST.get(task[0], 1))
+
+    n_workers = min(budget, len(tasks))
+    threads_per_task = max(1, budget // n_workers)
+
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("forkserver")) as pool:
+        futures = {
+            task: pool.submit(
+                _fit_and_score, task[0], threads_per_task, task[2] == "holdout", split_paths(*task),
+                params=params.get(f"{task[0]}_{task[1]}")
+            )
+            for task in tasks
+        }
+        scores = {task: future.result() for task, future in futures.items()}
+
+    results = {}
+    for horizon in horizons:
+        for model in models:
+            cv_auc = np.array([scores[(model, horizon, split)][0] for split in split_names if split != "holdout"])
+            test_auc, (fitted, y_prob) = scores[(model, horizon, "holdout")]
+
+            print(f"=== {model} {horizon} ===")
+            print("CV AUC per fold:", cv_auc)
+            print("Mean CV AUC:", cv_auc.mean())
+            print("Hold-out test AUC:", test_auc)
+            evaluation = None
+            if n_boot:
+                y_test = np.array(load_split(split_paths(model, horizon, "holdout"))[3])
+                evaluation = bootstrap_metrics(y_test, y_prob, n_boot=n_boot, n_jobs=budget)
+                print(f"Hold-out metrics with 95% bootstrap CI ({n_boot} replicates):")
+                print(evaluation.round(4).to_string())
+
+            # The hold-out model was fit on imputed arrays; put its imputer back in front
+            imputer = imputers[(horizon, model not in NATIVE_MISSING)]
+            pipeline = Pipeline(([("imputer", imputer)] if imputer is not None else []) + [("model", fitted)])
+            if model_dir is not None:
+                save_model(pipeline, feature_cols[horizon], f"{model}_{horizon}", model_dir)
+
+            results[(model, horizon)] = {
+                "cv_auc": cv_auc, "test_auc": test_auc, "evaluation": evaluation, "pipeline": pipeline
+            }
+    return results
+
+
+@instrumented()
+def train_model(df, model_name, horizon, horizons=HORIZONS, model_dir=None):
+    # One model for one horizon in this process (what the per-model scripts
+    # did): 5-fold CV AUC on the training split, then fit on the full training
+    # split and score the hold-out set. Saved as "{model_name}_{horizon}"
+    X, y = design_matrix(df, horizon, horizons)
+
+    train_idx, test_idx = split_indices(y)
+    X_train, X_test = X.iloc[train_idx], X.iloc[test_idx]
+    y_train, y_test = y[train_idx], y[test_idx]
+
+    steps = [] if model_name in NATIVE_MISSING else [("imputer", SimpleImputer(strategy="median"))]
+    pipeline = Pipeline(steps + [("model", MODELS[model_name]())])
+
+    cv_auc = cross_val_score(pipeline, X_train, y_train, cv=cv_folds(y_train), scoring="roc_auc")
+    print("CV AUC per fold:", cv_auc)
+    print("Mean CV AUC:", cv_auc.mean())
+
+    pipeline.fit(X_train, y_train)
+    y_prob = pipeline.predict_proba(X_test)[:, 1]
+    print("Hold-out test AUC:", roc_auc_score(y_test, y_prob))
+    print("Hold-out metrics with 95% bootstrap CI:")
+    print(bootstrap_metrics(y_test, y_prob).round(4).to_string())
+
+    if model_dir is not None:
+        save_model(pipeline, X.columns, f"{model_name}_{horizon}", model_dir)
+    return pipeline
@@ -0,0 +1,207 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sklearn.base import clone
+from sklearn.pipeline import Pipeline
+from scipy import sparse
+from sklearn.model_selection import ParameterGrid, train_test_split
+from sklearn.metrics import roc_auc_score
+from threadpoolctl import threadpool_limits
+from src.instrument import instrumented, stage
+from src.feature_store import stage_key
+from models.common import HORIZONS, MODELS, NATIVE_MISSING, for_sparse
+from models.train import MODEL_COST, prepare_horizon
+
+# Candidate hyperparameters per model; each grid point is passed to the
+# MODELS constructor as overrides of its defaults
+PARAM_GRIDS = {
+    "lr": {
+        "C": [0.01, 0.1, 1.0, 10.0],
+        # 0 is the ridge (L2) penalty, 1 the lasso (L1); liblinear takes no
+        # mix in between. lr_model turns it into penalty on older scikit-learn
+        "l1_ratio": [0.0, 1.0],
+    },
+    "rf": {
+        "n_estimators": [200, 500],
+        "max_depth": [4, 6, 10, None],
+        "min_samples_leaf": [5, 20, 50],
+        "max_features": ["sqrt", 0.3],
+    },
+    "hgb": {
+        "learning_rate": [0.03, 0.1],
+        "max_leaf_nodes": [15, 31, 63],
+        "min_samples_leaf": [20, 50],
+        "l2_regularization": [0.0, 1.0],
+    },
+}
+
+# Each rung keeps the best 1/HALVING_FACTOR of the candidates and gives them
+# HALVING_FACTOR times as many training rows; the last rung uses every row
+HALVING_FACTOR = 3
+MIN_RESOURCES = 500
+
+
+def _fold_data(model_name, splits):
+    # The CV folds with the model's preprocessing applied. prepare_horizon has
+    # already imputed them (unless the model is NATIVE_MISSING); any pipeline
+    # steps before the estimator (the scaler for lr) are fit here once per
+    # fold, not once per candidate
+    base = MODELS[model_name]()
+    folds = {}
+    for name, (X_fit, X_eval, y_fit, y_eval) in splits.items():
+        if name == "holdout":
+            continue
+        if isinstance(base, Pipeline):
+            prep = clone(for_sparse(base) if sparse.issparse(X_fit) else base)[:-1].fit(X_fit, y_fit)
+            X_fit, X_eval = prep.transform(X_fit), prep.transform(X_eval)
+        if not sparse.issparse(X_fit):
+            X_fit, X_eval = np.ascontiguousarray(X_fit, dtype=np.float32), np.ascontiguousarray(X_eval, dtype=np.float32)
+        folds[name] = (X_fit, X_eval, y_fit, y_eval)
+    return folds
+
+
+def _fit_candidate(model_name, params, n_jobs, X_fit, X_eval, y_fit, y_eval):
+    # Only the final estimator is fit; the folds are already preprocessed
+    model = MODELS[model_name](n_jobs=n_jobs, **params)
+    if isinstance(model, Pipeline):
+        model = model[-1]
+    with threadpool_limits(limits=n_jobs):
+        model.fit(X_fit, y_fit)
+        return roc_auc_score(y_eval, model.predict_proba(X_eval)[:, 1])
+
+
+def _subsample(y, n_samples, seed=42):
+    # Stratified, seeded subset of n_samples rows, so a resumed search sees the same rows
+    if n_samples >= len(y):
+        return np.arange(len(y))
+    idx, _ = train_test_split(np.arange(len(y)), train_size=n_samples, stratify=y, random_state=seed)
+    return np.sort(idx)
+
+
+def _result_key(params, n_samples, fold):
+    return json.dumps([params, n_samples, fold], sort_keys=True)
+
+
+def _load_results(path):
+    # Completed (candidate, rung, fold) evaluations from an earlier run; a line
+    # cut short by an interruption is ignored and simply recomputed
+    done = {}
+    if path.exists():
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                done[_result_key(record["params"], record["n_samples"], record["fold"])] = record["auc"]
+    return done
+
+
+def _rung_sizes(n_candidates, n_max, factor, min_resources):
+    # Training rows per rung: enough rungs to cut the grid down to one
+    # candidate, ending on the full fold
+    n_rungs = max(1, int(np.ceil(np.log(n_candidates) / np.log(factor))))
+    return [
+        max(min(min_resources, n_max), int(n_max / factor ** (n_rungs - 1 - rung)))
+        for rung in range(n_rungs)
+    ]
+
+
+def successive_halving(model_name, folds, grid, results_path, n_jobs=None, factor=HALVING_FACTOR, min_resources=MIN_RESOURCES):
+    # Successive-halving search of grid on the preprocessed folds. Every
+    # finished evaluation is appended to results_path as it completes, and
+    # evaluations already there are not rerun, so an interrupted search picks
+    # up where it stopped. Returns (best params, its mean CV AUC, rung history)
+    budget = n_jobs or os.cpu_count()
+    done = _load_results(results_path)
+    candidates = list(ParameterGrid(grid))
+    n_max = max(len(y_fit) for _, _, y_fit, _ in folds.values())
+
+    history = []
+    with open(results_path, "a") as log:
+        for rung, n_samples in enumerate(_rung_sizes(len(candidates), n_max, factor, min_resources)):
+            subsets = {fold: _subsample(y_fit, n_samples) for fold, (_, _, y_fit, _) in folds.items()}
+            todo = [
+                (params, fold) for params in candidates for fold in folds
+                if _result_key(params, n_samples, fold) not in done
+            ]
+            print(
+                f"{model_name} rung {rung}: {len(candidates)} candidates on {n_samples:,} rows "
+                f"({len(candidates) * len(folds) - len(todo)} of {len(candidates) * len(folds)} fits cached)"
+            )
+
+            if todo:
+                n_workers = min(budget, len(todo))
+                threads_per_task = max(1, budget // n_workers)
+                with stage(f"tune {model_name} rung {rung}", rows_in=n_samples * len(todo)):
+                    context = multiprocessing.get_context("forkserver")
+                    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as pool:
+                        futures = {}
+                        for params, fold in todo:
+                            X_fit, X_eval, y_fit, y_eval = folds[fold]
+                            idx = subsets[fold]
+                            future = pool.submit(
+                                _fit_candidate, model_name, params, threads_per_task, X_fit[idx], X_eval, y_fit[idx], y_eval
+                            )
+                            futures[future] = (params, fold)
+                        for future in as_completed(futures):
+                            params, fold = futures[future]
+                            auc = future.result()
+                            done[_result_key(params, n_samples, fold)] = auc
+                            log.write(json.dumps({"params": params, "n_samples": n_samples, "fold": fold, "auc": auc}) + "\n")
+                            log.flush()
+
+            scores = np.array([
+                np.mean([done[_result_key(params, n_samples, fold)] for fold in folds]) for params in candidates
+            ])
+            ranked = np.argsort(-scores, kind="stable")
+            history.append({"rung": rung, "n_samples": n_samples, "scores": list(zip(candidates, scores))})
+            candidates = [candidates[i] for i in ranked[:max(1, int(np.ceil(len(candidates) / factor)))]]
+
+    return candidates[0], float(scores[ranked[0]]), history
+
+
+@instrumented()
+def tune_models(df, models=("lr", "rf"), horizons=HORIZONS, n_jobs=None, tune_dir="tuning", grids=None,
+                factor=HALVING_FACTOR, min_resources=MIN_RESOURCES, lab_block=None):
+    # Successive-halving search for every model and horizon on the same CV
+    # folds train_models uses. Results go to tune_dir, one file per search
+    # keyed by the data and grid, so rerunning after an interruption (or with
+    # a new model) only fits what is missing. Returns and saves
+    # best_params.json: {"{model}_{horizon}": {"params", "cv_auc"}}, whose
+    # params can be passed to train_models (with the same lab_block, if any)
+    grids = grids or PARAM_GRIDS
+    for model_name in [m for m in models if m not in grids]:
+        print(f"{model_name}: no parameter grid, not tuned")
+    models = [m for m in models if m in grids]
+    tune_dir = Path(tune_dir)
+    tune_dir.mkdir(parents=True, exist_ok=True)
+    data_key = str(pd.util.hash_pandas_object(df, index=False).to_numpy().sum())
+    if lab_block is not None:
+        data_key += str(pd.util.hash_array(lab_block["values"].data).sum())
+
+    best = {}
+    for horizon in horizons:
+        prepared = {
+            impute: prepare_horizon(df, horizon, horizons, impute, lab_block)[:2]
+            for impute in {model not in NATIVE_MISSING for model in models}
+        }
+        for model_name in sorted(models, key=lambda m: -MODEL_COST.get(m, 1)):
+            splits, feature_cols = prepared[model_name not in NATIVE_MISSING]
+            key = stage_key(data_key, horizons, horizon, feature_cols, grids[model_name], factor, min_resources)
+            params, cv_auc, _ = successive_halving(
+                model_name, _fold_data(model_name, splits), grids[model_name],
+                tune_dir / f"{model_name}_{horizon}_{key}.jsonl", n_jobs, factor, min_resources
+            )
+            print(f"=== {model_name} {horizon} best ===")
+            print("Params:", params)
+            print("Mean CV AUC:", cv_auc)
+            best[f"{model_name}_{horizon}"] = {"params": params, "cv_auc": cv_auc}
+
+    with open(tune_dir / "best_params.json", "w") as f:
+        json.dump(best, f, indent=2)
+    return best
@@ -1,6 +1,11 @@
 import pandas as pd
 import numpy as np
-import re
+import hashlib
+import json
+from pathlib import Path
+from src.instrument import instrumented
+from src.concepts import drug_concepts, category_regexes
+from src.windows import WINDOWS, join_windows, window_date_range
 
 BMAS = [
     "zoledronic acid", "100 ML zoledronic acid 0.04 MG/ML Injection",
@@ -47,68 +52,119 @@ TARGETED_THERAPY = [
     "sunitinib"
 ]
 
-def add_drug_features(df_features, df_drug_exposure):
-    
-    df_out = df_features.copy()
-    
-    windows = {
-        '6m': {'start_days': 270, 'end_days': 120},   
-        '12m': {'start_days': 540, 'end_days': 180}   
+DRUG_CATEGORIES = {
+    'bmas': BMAS,
+    'chemo': CHEMOTHERAPY,
+    'targeted': TARGETED_THERAPY
+}
+
+DRUG_EXPOSURE_COLUMNS = ['person_id', 'concept_name', 'drug_exposure_start_date']
+
+
+def drug_pattern(categories=DRUG_CATEGORIES):
+    # Any drug in any category, for the scan filter (from the concept dictionary)
+    return drug_concepts(categories)['pattern']
+
+
+def category_patterns(categories=DRUG_CATEGORIES):
+    # One compiled pattern per category, compiled once per process;
+    # concept names are lowercased before matching
+    return category_regexes(categories)
+
+
+def drug_lookup_path(lookup_dir, categories=DRUG_CATEGORIES):
+    # Lookup files are keyed by the drug lists, so editing a list starts a fresh table
+    fingerprint = hashlib.sha1(json.dumps(categories, sort_keys=True).encode()).hexdigest()[:12]
+    return Path(lookup_dir) / f'drug_lookup_{fingerprint}.parquet'
+
+
+def classify_drug_names(concept_names, lookup_dir=None, categories=DRUG_CATEGORIES):
+    # Category flags for each distinct concept name. Names already in the
+    # persistent lookup table (if lookup_dir is given) skip matching entirely;
+    # new names are matched once and appended to it.
+    names = pd.Index(pd.unique(concept_names.dropna()), dtype=object)
+
+    lookup = pd.DataFrame(columns=list(categories), dtype=bool)
+    path = drug_lookup_path(lookup_dir, categories) if lookup_dir is not None else None
+    if path is not None and path.exists():
+        lookup = pd.read_parquet(path).set_index('concept_name')
+
+    new_names = names.difference(lookup.index)
+    if len(new_names):
+        # Names exactly as listed are already classified in the concept
+        # dictionary; only the rest are matched
+        listed = drug_concepts(categories)['names']
+        patterns = category_patterns(categories)
+        new_flags = pd.DataFrame(
+            [
+                listed[name] if name in listed else [bool(pattern.search(name.lower())) for pattern in patterns.values()]
+                for name in new_names
+            ],
+            index=pd.Index(new_names, name='concept_name'), columns=list(categories), dtype=bool
+        )
+        lookup = pd.concat([lookup, new_flags]) if len(lookup) else new_flags
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            lookup.rename_axis('concept_name').reset_index().to_parquet(path, index=False)
+
+    return lookup.reindex(names).astype(bool)
+
+
+def drug_exposure_scan(df_features, windows=WINDOWS, categories=DRUG_CATEGORIES):
+    # Columns and row filters add_drug_features needs (pushed down by load_data)
+    min_date, max_date = window_date_range(df_features, windows)
+    return {
+        'columns': DRUG_EXPOSURE_COLUMNS,
+        'filters': [
+            ('person_id', 'in', df_features['person_id'].unique()),
+            ('drug_exposure_start_date', '>=', min_date),
+            ('drug_exposure_start_date', '<=', max_date),
+            ('concept_name', 'match', drug_pattern(categories)),
+        ],
     }
+
+@instrumented()
+def drug_feature_block(df_features, df_drug_exposure, windows=WINDOWS, lookup_dir=None, categories=DRUG_CATEGORIES):
+    # {category}_{window} exposure flags, aligned to df_features' index
     
-    # Reference date once
-    df_out['ref_date'] = df_out['first_bone_event_date'].fillna(df_out['last_of_death_or_visit'])
-    
-    for suffix, days in windows.items():
-        df_out[f'win_start_{suffix}'] = df_out['ref_date'] - pd.Timedelta(days=days['start_days'])
-        df_out[f'win_end_{suffix}'] = df_out['ref_date'] - pd.Timedelta(days=days['end_days'])
-    
-    min_date = min(df_out['win_start_6m'].min(), df_out['win_start_12m'].min())
-    max_date = max(df_out['win_end_6m'].max(), df_out['win_end_12m'].max())
-    patients = set(df_out['person_id'])
+    min_date, max_date = window_date_range(df_features, windows)
+    patients = set(df_features['person_id'])
     
     df_drug = df_drug_exposure[
         (df_drug_exposure['person_id'].isin(patients)) &
         (df_drug_exposure['drug_exposure_start_date'].between(min_date, max_date))
     ].copy()
     
-    # Target drugs once
-    all_drugs = BMAS + CHEMOTHERAPY + TARGETED_THERAPY
-    pattern = '|'.join(re.escape(d.lower()) for d in all_drugs)
-    df_target = df_drug[
-        df_drug['concept_name'].str.lower().str.contains(pattern, na=False, regex=True)
-    ].copy()
-    
-    # Categorize once
-    df_target['bmas'] = df_target['concept_name'].str.lower().str.contains(
-        '|'.join(re.escape(d.lower()) for d in BMAS), na=False, regex=True
-    ).astype(int)
-    df_target['chemo'] = df_target['concept_name'].str.lower().str.contains(
-        '|'.join(re.escape(d.lower()) for d in CHEMOTHERAPY), na=False, regex=True
-    ).astype(int)
-    df_target['targeted'] = df_target['concept_name'].str.lower().str.contains(
-        '|'.join(re.escape(d.lower()) for d in TARGETED_THERAPY), na=False, regex=True
-    ).astype(int)
-    
-    # Process both windows
-    for suffix in ['6m', '12m']:
-        # Merge with this window
-        df_merged = df_target.merge(
-            df_out[['person_id', f'win_start_{suffix}', f'win_end_{suffix}']], 
-            on='person_id'
-        )
-        
-        df_valid = df_merged[
-            df_merged['drug_exposure_start_date'].between(
-                df_merged[f'win_start_{suffix}'], df_merged[f'win_end_{suffix}']
-            )
-        ]
-        
-        # any exposure per category
-        for cat in ['bmas', 'chemo', 'targeted']:
-            exposed = df_valid.groupby('person_id')[cat].any()
-            df_out[f'{cat}_{suffix}'] = df_out['person_id'].map(exposed).fillna(0).astype(int)
+    # Classify each distinct concept name once and broadcast back by code
+    codes, names = pd.factorize(df_drug['concept_name'])
+    flags = classify_drug_names(pd.Series(names, dtype=object), lookup_dir, categories).to_numpy()
+    flags = np.vstack([flags, np.zeros((1, len(categories)), dtype=bool)])  # code -1 = missing name
+    row_flags = flags[codes]
+
+    target = row_flags.any(axis=1)
+    df_target = df_drug[target].copy()
+    for i, cat in enumerate(categories):
+        df_target[cat] = row_flags[target, i]
     
-    # Clean up
-    drop_cols = ['ref_date'] + [col for col in df_out.columns if col.startswith('win_')]
-    return df_out.drop(columns=drop_cols)
+    # Tag each exposure with the window(s) it falls in
+    df_valid = join_windows(df_target, df_features, 'drug_exposure_start_date', windows)
+
+    # any exposure per category and window
+    categories = list(categories)
+    exposed = (
+        df_valid.groupby(['person_id', 'window'], observed=True)[categories].any()
+        .unstack('window')
+        .reindex(columns=pd.MultiIndex.from_product([categories, list(windows)]))
+    )
+    columns = {}
+    for suffix in windows:
+        for cat in categories:
+            columns[f'{cat}_{suffix}'] = df_features['person_id'].map(exposed[(cat, suffix)]).fillna(0).astype(np.uint8)
+
+    return pd.DataFrame(columns, index=df_features.index)
+
+
+@instrumented()
+def add_drug_features(df_features, df_drug_exposure, windows=WINDOWS, lookup_dir=None, categories=DRUG_CATEGORIES):
+    df_out = df_features.copy()
+    return pd.concat([df_out, drug_feature_block(df_out, df_drug_exposure, windows, lookup_dir, categories)], axis=1)
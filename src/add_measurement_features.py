@@ -1,6 +1,12 @@
 import pandas as pd
 import numpy as np
-import re
+from scipy import sparse
+from src.parquet_scan import iter_batches
+from src.instrument import instrumented
+from src.windows import WINDOWS, join_windows, reference_dates, window_date_range
+# safe_lab_name moved to src/concepts.py; re-exported here for callers that
+# still import it from this module
+from src.concepts import safe_lab_name, lab_columns
 
 HIGH_FREQ_LABS = [
     "Systolic blood pressure", "Diastolic blood pressure", "Heart rate", "Body temperature",
@@ -31,76 +37,310 @@ HIGH_FREQ_LABS = [
     "Lactate dehydrogenase [Enzymatic activity/volume] in Serum or Plasma by Lactate to pyruvate reaction"
 ]
 
+# Per (window, lab, person) statistics in the long lab_first_last table.
+# Besides n (rows) and the first/last non-null value, they are mergeable sums
+# over non-null values -- count, sum, sum of squares, and sums of t, t^2 and
+# t*value where t is days relative to the reference date -- plus min, max and
+# the latest t. Partial tables (batches, shards) combine with STAT_MERGE, and
+# every wide aggregation below is derived from them without another pass.
+STAT_MERGE = {
+    'n': 'sum', 'count': 'sum', 'sum': 'sum', 'sum_sq': 'sum',
+    'sum_t': 'sum', 'sum_tt': 'sum', 'sum_tv': 'sum',
+    'min': 'min', 'max': 'max', 'last_t': 'max',
+}
+LAB_STATS_COLUMNS = ['window', 'concept_name', 'person_id', 'n', 'first_value', 'last_value'] + list(STAT_MERGE)[1:]
 
-def add_measurement_features(df_features, df_measurements):
-    
-    df_out = df_features.copy()
-    df_out['ref_date'] = df_out['first_bone_event_date'].fillna(df_out['last_of_death_or_visit'])
-    
-    # BOTH windows
-    df_out['win_start_6m'] = df_out['ref_date'] - pd.Timedelta(days=270)
-    df_out['win_end_6m'] = df_out['ref_date'] - pd.Timedelta(days=120)
-    df_out['win_start_12m'] = df_out['ref_date'] - pd.Timedelta(days=540)
-    df_out['win_end_12m'] = df_out['ref_date'] - pd.Timedelta(days=180)
-    df_out['T_ref'] = pd.to_datetime(df_out['first_bone_event_date'].fillna(df_out['last_of_death_or_visit']))
+
+def _std(stats):
+    # Sample standard deviation (ddof=1) from the sums
+    var = (stats['sum_sq'] - stats['sum'] ** 2 / stats['count']) / (stats['count'] - 1)
+    return np.sqrt(var.clip(lower=0)).where(stats['count'] > 1)
+
+
+def _slope(stats):
+    # Least-squares slope of value over time, per day
+    denom = stats['count'] * stats['sum_tt'] - stats['sum_t'] ** 2
+    return ((stats['count'] * stats['sum_tv'] - stats['sum_t'] * stats['sum']) / denom).where(denom > 0)
+
+
+# Wide lab features, computed from the long lab_first_last table; each
+# becomes a {lab}_{name}_{window} column
+LAB_AGGREGATIONS = {
+    'delta': lambda stats: stats['last_value'] - stats['first_value'],
+    'last': lambda stats: stats['last_value'],
+    'first': lambda stats: stats['first_value'],
+    'count': lambda stats: stats['n'],
+    'min': lambda stats: stats['min'],
+    'max': lambda stats: stats['max'],
+    'mean': lambda stats: (stats['sum'] / stats['count']).where(stats['count'] > 0),
+    'std': _std,
+    'slope': _slope,
+    'days_since_last': lambda stats: -stats['last_t'],
+}
+LAB_FEATURES = ['delta', 'last']
+
+MEASUREMENT_COLUMNS = ['person_id', 'concept_name', 'measurement_date', 'value_as_number']
+
+
+def lab_dtype(labs=HIGH_FREQ_LABS):
+    # Fixed categories, so lab tables from different batches, shards or cache
+    # files concatenate without falling back to object strings
+    return pd.CategoricalDtype(labs)
+
+
+def measurement_scan(df_features, windows=WINDOWS, labs=HIGH_FREQ_LABS):
+    # Columns and row filters add_measurement_features needs (pushed down by load_data)
+    min_date, max_date = window_date_range(df_features, windows)
+    return {
+        'columns': MEASUREMENT_COLUMNS,
+        'filters': [
+            ('person_id', 'in', df_features['person_id'].unique()),
+            ('measurement_date', '>=', min_date),
+            ('measurement_date', '<=', max_date),
+            ('concept_name', 'in', labs),
+        ],
+    }
+
+
+def value_stats(df_labs, df_features, keys, first_last=False):
+    # The mergeable STAT_MERGE columns for window-tagged measurement rows,
+    # grouped by keys. Sums and extremes only, so no ordering is needed;
+    # first_last=True also takes the first/last non-null value in row order
+    # within the same grouping
+    ref_date = pd.Series(reference_dates(df_features).to_numpy(), index=df_features['person_id'].to_numpy())
+    value = df_labs['value_as_number'].astype('float64')
+    valid = value.notna()
+    t = ((df_labs['measurement_date'] - df_labs['person_id'].map(ref_date)) / pd.Timedelta(days=1)).where(valid)
+    parts = pd.DataFrame({
+        **{k: df_labs[k] for k in keys},
+        'n': np.ones(len(df_labs), dtype=np.int64), 'count': valid.astype(np.int64),
+        'sum': value, 'sum_sq': value * value, 'sum_t': t, 'sum_tt': t * t, 'sum_tv': t * value,
+        'min': value, 'max': value, 'last_t': t,
+    })
+    aggregations = dict(STAT_MERGE)
+    if first_last:
+        parts['first_value'] = parts['last_value'] = df_labs['value_as_number']
+        aggregations.update(first_value='first', last_value='last')
+    return parts.groupby(keys, observed=True).agg(aggregations)
+
+
+@instrumented()
+def lab_first_last(df_features, df_measurements, windows=WINDOWS, labs=HIGH_FREQ_LABS):
+    # Long table of (window, concept_name, person_id) with the row count n,
+    # the first and last non-null value in the window and the STAT_MERGE
+    # statistics (LAB_STATS_COLUMNS). Wide features come from
+    # lab_feature_block; keeping this step separate lets cached or sharded
+    # partial tables be concatenated before the cohort-wide threshold is applied
     df_measurements['measurement_date'] = pd.to_datetime(df_measurements['measurement_date'])
     
     # **CRITICAL: PRE-FILTER to relevant patients/dates FIRST**
-    patients = df_out['person_id'].unique()
-    min_date = df_out[['win_start_6m', 'win_start_12m']].min().min()
-    max_date = df_out[['win_end_6m', 'win_end_12m']].max().max()
+    patients = df_features['person_id'].unique()
+    min_date, max_date = window_date_range(df_features, windows)
     
     df_labs = df_measurements[
         (df_measurements['person_id'].isin(patients)) &
         (df_measurements['measurement_date'].between(min_date, max_date)) &
-        (df_measurements['concept_name'].isin(HIGH_FREQ_LABS))  # ONLY your 55 labs!
-    ].copy()
+        (df_measurements['concept_name'].isin(labs))  # ONLY your 55 labs!
+    ]
+    df_labs = df_labs.assign(concept_name=df_labs['concept_name'].astype(lab_dtype(labs)))
     
-    print(f"Filtered to {len(df_labs):,} measurements for 55 high-freq labs")
+    print(f"Filtered to {len(df_labs):,} measurements for {len(labs)} high-freq labs")
     
-    # **ONE broadcast merge** - windows to ALL labs
-    df_labs = df_labs.merge(
-        df_out[['person_id', 'win_start_6m', 'win_end_6m', 'win_start_12m', 'win_end_12m']],
-        on='person_id',
-        how='left'
+    # **Interval join** - one long frame of rows per window, sorted by person and date
+    df_labs = join_windows(df_labs, df_features, 'measurement_date', windows)
+
+    print(' | '.join(f"{suffix} window: {(df_labs['window'] == suffix).sum():,} records" for suffix in windows))
+
+    # **ONE groupby** for every (window, lab, patient); rows are already in
+    # date order within each patient for first/last, the rest are sums
+    stats = value_stats(df_labs, df_features, ['window', 'concept_name', 'person_id'], first_last=True)
+    return stats.reset_index()[LAB_STATS_COLUMNS]
+
+
+def _passing_stats(lab_stats, windows, labs, aggregations, min_rows=20):
+    # For labs with at least min_rows rows in a window: one row per (window,
+    # lab, person) with its aggregations, and the feature columns they fill:
+    # {f'{safe_name}_{agg}_{suffix}': (agg, lab_name, suffix)}. Labs whose safe
+    # names collide (the two GFR labs) keep the column position of the first
+    # and the values of the last, as repeated column assignment did before.
+    # Aggregations go in a frame of their own: some share a name with a stat
+    # ('count' is n, not the non-null count that mean, std and slope read)
+    counts = lab_stats.groupby(['window', 'concept_name'], observed=True)['n'].sum()
+    passing = counts[counts >= min_rows].index  # Min threshold
+    stats = lab_stats.set_index(['window', 'concept_name'])
+    stats = stats[stats.index.isin(passing)].reset_index()
+    first_last = stats[['window', 'concept_name', 'person_id']].assign(
+        **{agg: LAB_AGGREGATIONS[agg](stats) for agg in aggregations}
     )
+
+    columns = {}
+    safe_names = lab_columns(labs)
+    for lab_name in labs:
+        safe_name = safe_names[lab_name]
+        for suffix in windows:
+            if (suffix, lab_name) in passing:
+                for agg in aggregations:
+                    columns[f'{safe_name}_{agg}_{suffix}'] = (agg, lab_name, suffix)
+    return first_last, columns
+
+
+@instrumented()
+def lab_feature_block(person_ids, lab_stats, windows=WINDOWS, labs=HIGH_FREQ_LABS, aggregations=LAB_FEATURES, fill_value=0,
+                      min_rows=20):
+    # Pivot the long lab_first_last table into the wide block of
+    # LAB_AGGREGATIONS (default _delta/_last), aligned to person_ids. Labs
+    # with fewer than min_rows rows in a window are skipped. Patients without
+    # the lab get fill_value (None leaves them NaN).
+    first_last, columns = _passing_stats(lab_stats, windows, labs, aggregations, min_rows)
+
+    if first_last.empty:
+        wide = pd.DataFrame()
+    else:
+        wide = first_last.pivot_table(
+            index='person_id', columns=['concept_name', 'window'],
+            values=list(aggregations), aggfunc='first', dropna=False
+        )
+
+    block = wide.reindex(columns=list(columns.values())).reindex(person_ids.to_numpy())
+    block.columns = list(columns.keys())
+    block.index = person_ids.index
+    return block if fill_value is None else block.fillna(fill_value)
+
+
+@instrumented()
+def lab_feature_sparse(person_ids, lab_stats, windows=WINDOWS, labs=HIGH_FREQ_LABS, aggregations=LAB_FEATURES):
+    # The lab_feature_block columns as scipy CSR matrices, one row per
+    # person_ids entry, built straight from the long table so memory scales
+    # with the measured (patient, lab, window) cells. 'values' stores only
+    # observed values (missing reads as 0, like the dense block's default
+    # fill) and 'observed' is the explicit mask of which cells were measured,
+    # since a measured value can itself be 0
+    first_last, columns = _passing_stats(lab_stats, windows, labs, aggregations)
+    source = {key: i for i, key in enumerate(dict.fromkeys((lab_name, suffix) for _, lab_name, suffix in columns.values()))}
+    n_aggs = len(aggregations)
+
+    rows = pd.Index(person_ids.to_numpy()).get_indexer(first_last['person_id'])
+    base = np.array([
+        source.get(key, -1) for key in zip(first_last['concept_name'].astype(object), first_last['window'].astype(object))
+    ], dtype=np.int64)
+    keep = (rows >= 0) & (base >= 0)
+
+    # One entry per (row, aggregation); NaN aggregations (std of one value)
+    # count as missing, as they do in the dense block
+    values = np.column_stack([first_last[agg].to_numpy(dtype=np.float32) for agg in aggregations])[keep].ravel()
+    cols = (base[keep][:, None] * n_aggs + np.arange(n_aggs)).ravel()
+    rows = np.repeat(rows[keep], n_aggs)
+    present = ~np.isnan(values)
+    shape = (len(person_ids), len(columns))
+
+    # Column i*n_aggs + j is aggregation j of the i-th (lab, window); reorder to
+    # the dense block's column order
+    order = np.empty(len(columns), dtype=np.int64)
+    for position, (agg, lab_name, suffix) in enumerate(columns.values()):
+        order[source[(lab_name, suffix)] * n_aggs + list(aggregations).index(agg)] = position
+    cols = order[cols]
+
+    observed = sparse.csr_matrix(
+        (np.ones(present.sum(), dtype=bool), (rows[present], cols[present])), shape=shape
+    )
+    return {
+        'values': sparse.csr_matrix((values[present], (rows[present], cols[present])), shape=shape, dtype=np.float32),
+        'observed': observed,
+        'columns': list(columns),
+    }
+
+
+@instrumented()
+def add_measurement_features(df_features, df_measurements, windows=WINDOWS, labs=HIGH_FREQ_LABS, aggregations=LAB_FEATURES):
     
-    # **VECTORIZED window filtering**
-    df_labs_6m = df_labs[
-        df_labs['measurement_date'].between(df_labs['win_start_6m'], df_labs['win_end_6m'])
-    ].sort_values(['person_id', 'concept_name', 'measurement_date'])
-    
-    df_labs_12m = df_labs[
-        df_labs['measurement_date'].between(df_labs['win_start_12m'], df_labs['win_end_12m'])
-    ].sort_values(['person_id', 'concept_name', 'measurement_date'])
-    
-    print(f"6m window: {len(df_labs_6m):,} records | 12m window: {len(df_labs_12m):,} records")
-    
-    # **55 labs × 4 features = 220 total features (delta + last for 2 windows)**
-    for lab_name in HIGH_FREQ_LABS:
-        safe_name = (lab_name.lower()
-                    .replace(' ', '_').replace('/', '_').replace('[', '').replace(']', '')
-                    .replace('(', '').replace(')', '').replace(',', '')[:25])
-    # 6m features
-        lab_6m = df_labs_6m[df_labs_6m['concept_name'] == lab_name]
-        if len(lab_6m) >= 20:  # Min threshold
-            first_6m = lab_6m.groupby('person_id')['value_as_number'].first()
-            last_6m = lab_6m.groupby('person_id')['value_as_number'].last()
-            delta_6m = last_6m - first_6m
-            df_out[f'{safe_name}_delta_6m'] = df_out['person_id'].map(delta_6m).fillna(0)
-            df_out[f'{safe_name}_last_6m'] = df_out['person_id'].map(last_6m).fillna(0)
-        
-        # 12m features  
-        lab_12m = df_labs_12m[df_labs_12m['concept_name'] == lab_name]
-        if len(lab_12m) >= 20:
-            first_12m = lab_12m.groupby('person_id')['value_as_number'].first()
-            last_12m = lab_12m.groupby('person_id')['value_as_number'].last()
-            delta_12m = last_12m - first_12m
-            df_out[f'{safe_name}_delta_12m'] = df_out['person_id'].map(delta_12m).fillna(0)
-            df_out[f'{safe_name}_last_12m'] = df_out['person_id'].map(last_12m).fillna(0)
-    
-    # Cleanup
-    drop_cols = ['ref_date'] + [col for col in df_out.columns if col.startswith('win_')]
-    return df_out.drop(columns=drop_cols)
+    df_out = df_features.copy()
+    df_out['T_ref'] = pd.to_datetime(df_out['first_bone_event_date'].fillna(df_out['last_of_death_or_visit']))
+
+    # **55 labs × 2 features per window (delta + last)**
+    lab_stats = lab_first_last(df_out, df_measurements, windows, labs)
+    return pd.concat([df_out, lab_feature_block(df_out['person_id'], lab_stats, windows, labs, aggregations)], axis=1)
 
 
+def _reduce_first_last(df):
+    # Collapse rows to one per (person_id, concept_name) keeping the earliest
+    # and latest value. Rows are in scan order, so ties on date resolve the way
+    # the stable sort + groupby first/last does in add_measurement_features
+    df = df.reset_index(drop=True)
+    keys = ['person_id', 'concept_name']
+    first_idx = df.groupby(keys, sort=False, observed=True)['first_date'].idxmin()
+    last_idx = df.iloc[::-1].groupby(keys, sort=False, observed=True)['last_date'].idxmax()
+    first = df.loc[first_idx, keys + ['first_date', 'first_value']].set_index(keys)
+    last = df.loc[last_idx, keys + ['last_date', 'last_value']].set_index(keys)
+    return first.join(last).reset_index()
+
+
+@instrumented()
+def lab_first_last_streaming(df_features, measurement_path, windows=WINDOWS, batch_size=1_000_000, labs=HIGH_FREQ_LABS):
+    # Same table as lab_first_last, but the measurement table is read batch by
+    # batch and only running statistics and first/last values per
+    # (person, lab, window) are kept, so memory grows with cohort size x lab
+    # count, not measurement rows
+    patients = df_features['person_id'].unique()
+
+    totals = {suffix: None for suffix in windows}
+    state = {
+        suffix: pd.DataFrame(columns=['person_id', 'concept_name', 'first_date', 'first_value', 'last_date', 'last_value'])
+        for suffix in windows
+    }
+    n_rows = 0
+
+    scan = measurement_scan(df_features, windows, labs)
+    for batch in iter_batches(measurement_path, scan['columns'], scan['filters'], batch_size):
+        batch['measurement_date'] = pd.to_datetime(batch['measurement_date'])
+        batch = batch[
+            batch['person_id'].isin(patients) &
+            batch['concept_name'].isin(labs)
+        ]
+        batch = batch.assign(concept_name=batch['concept_name'].astype(lab_dtype(labs)))
+        n_rows += len(batch)
+        batch = join_windows(batch, df_features, 'measurement_date', windows)
+
+        for suffix in windows:
+            in_window = batch[batch['window'] == suffix]
+            stats = value_stats(in_window, df_features, ['person_id', 'concept_name'])
+            if totals[suffix] is not None:
+                stats = pd.concat([totals[suffix], stats]).groupby(level=[0, 1], observed=True).agg(STAT_MERGE)
+            totals[suffix] = stats
+
+            valued = in_window[in_window['value_as_number'].notna()]
+            part = pd.DataFrame({
+                'person_id': valued['person_id'],
+                'concept_name': valued['concept_name'],
+                'first_date': valued['measurement_date'],
+                'first_value': valued['value_as_number'],
+                'last_date': valued['measurement_date'],
+                'last_value': valued['value_as_number'],
+            })
+            if len(state[suffix]):
+                part = pd.concat([state[suffix], part], ignore_index=True)
+            state[suffix] = _reduce_first_last(part)
+
+    print(f"Streamed {n_rows:,} measurements for {len(labs)} high-freq labs")
+
+    parts = []
+    for suffix in windows:
+        if totals[suffix] is None or totals[suffix].empty:
+            continue
+        stats = totals[suffix].reset_index()
+        first_last = stats.merge(state[suffix], on=['person_id', 'concept_name'], how='left')
+        parts.append(first_last.assign(window=suffix))
+
+    if not parts:
+        return pd.DataFrame(columns=LAB_STATS_COLUMNS)
+    return pd.concat(parts, ignore_index=True)[LAB_STATS_COLUMNS]
+
+
+@instrumented()
+def add_measurement_features_streaming(df_features, measurement_path, windows=WINDOWS, batch_size=1_000_000,
+                                       labs=HIGH_FREQ_LABS, aggregations=LAB_FEATURES):
+    # Same output as add_measurement_features, reading measurements in batches
+    df_out = df_features.copy()
+    df_out['T_ref'] = pd.to_datetime(df_out['first_bone_event_date'].fillna(df_out['last_of_death_or_visit']))
+
+    lab_stats = lab_first_last_streaming(df_out, measurement_path, windows, batch_size, labs)
+    return pd.concat([df_out, lab_feature_block(df_out['person_id'], lab_stats, windows, labs, aggregations)], axis=1)
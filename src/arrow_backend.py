@@ -0,0 +1,340 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from src.parquet_scan import scan_table
+from src.instrument import instrumented
+from src.windows import WINDOWS, reference_dates, window_date_range, window_positions
+from src.make_dataframe import EVENT_RULES
+from src.add_measurement_features import HIGH_FREQ_LABS, LAB_STATS_COLUMNS, lab_dtype, measurement_scan
+from src.add_drug_features import DRUG_CATEGORIES, classify_drug_names, drug_exposure_scan
+
+# Arrow-native versions of the cohort, lab and drug stages, selected with
+# load_data(..., backend='arrow'). Tables stay in Arrow from the pushed-down
+# scan to the final aggregate: filters and group-bys run in Arrow compute
+# (the group-bys on its thread pool), window matching uses the same
+# searchsorted positions as the pandas path, and only the per-patient
+# results are converted to pandas. Each function returns exactly what its
+# pandas counterpart returns; mismatched_columns checks that column for
+# column.
+# Dates are compared at day resolution, as OMOP *_date columns are dates.
+
+
+def _days(column):
+    # Day numbers since the epoch (int32) for date, timestamp or ISO string columns
+    if pa.types.is_dictionary(column.type):
+        column = column.cast(column.type.value_type)
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        column = pc.cast(column, pa.date32())
+    elif pa.types.is_timestamp(column.type):
+        column = pc.cast(column, pa.date32(), safe=False)
+    return pc.cast(column, pa.int32())
+
+
+def _date_type(arrow_type):
+    # Arrow type whose pandas conversion has the dtype the pandas path gives a
+    # source date column: dates and timestamps keep their type, strings go
+    # through pd.to_datetime
+    if pa.types.is_timestamp(arrow_type) or pa.types.is_date(arrow_type):
+        return arrow_type
+    return pa.timestamp('us')
+
+
+def _finer(type_a, type_b):
+    # Result type of np.where over two such columns
+    units = ['s', 'ms', 'us', 'ns']
+    unit = {t: units.index(t.unit) if pa.types.is_timestamp(t) else 1 for t in (type_a, type_b)}
+    return type_a if unit[type_a] >= unit[type_b] else type_b
+
+
+def _dates(days, date_type=pa.date32()):
+    return pc.cast(pc.cast(days, pa.date32()), date_type)
+
+
+def _name_codes(column):
+    # (codes, names) for a string column, each distinct name listed once, so
+    # matching and lookups cost one call per name rather than per row. Null
+    # names get code -1.
+    codes, dictionaries, offset = [], [], 0
+    for chunk in column.chunks:
+        if not pa.types.is_dictionary(chunk.type):
+            chunk = pc.dictionary_encode(chunk)
+        idx = pc.fill_null(chunk.indices, -1).to_numpy().astype(np.int64)
+        codes.append(np.where(idx >= 0, idx + offset, -1))
+        dictionaries.append(chunk.dictionary.cast(pa.string()))
+        offset += len(chunk.dictionary)
+
+    if not dictionaries:
+        return np.array([], dtype=np.int64), np.array([], dtype=object)
+    # Chunks usually share one dictionary; collapse repeats across chunks
+    remap, names = pd.factorize(pa.concat_arrays(dictionaries).to_numpy(zero_copy_only=False))
+    codes = np.concatenate(codes)
+    return np.where(codes >= 0, np.append(remap, -1)[codes], -1), np.asarray(names, dtype=object)
+
+
+def _per_row(codes, per_name, missing):
+    # Broadcast a per-name array back to rows; code -1 gets `missing`
+    return np.append(per_name, np.array([missing], dtype=per_name.dtype))[codes]
+
+
+def _match_names(names, pattern):
+    hits = pc.match_substring_regex(pa.array(names, pa.string()), pattern, ignore_case=True)
+    return pc.fill_null(hits, False).to_numpy(zero_copy_only=False)
+
+
+def _match_procedures(procedures, codes, names, match):
+    mask = np.zeros(procedures.num_rows, dtype=bool)
+    if 'pattern' in match:
+        mask |= _per_row(codes, _match_names(names, match['pattern']), False)
+    if 'concept_ids' in match:
+        mask |= pc.fill_null(pc.is_in(procedures['procedure_concept_id'], pa.array(match['concept_ids'])), False).to_numpy()
+    return mask
+
+
+def _grouped_day(person_id, day, mask, agg):
+    # Per-person min or max day over the masked rows: table of person_id, day
+    mask = pa.array(mask)
+    grouped = pa.table({'person_id': pc.filter(person_id, mask), 'day': pc.filter(day, mask)}).group_by('person_id').aggregate([('day', agg)])
+    return pa.table({'person_id': grouped['person_id'], 'day': grouped[f'day_{agg}']})
+
+
+def event_days(procedures, rules=EVENT_RULES):
+    # Same rules as make_dataframe.event_dates, on an Arrow procedure table:
+    # earliest event day per person_id as a table of person_id, day
+    person_id = procedures['person_id']
+    day = _days(procedures['procedure_date'])
+    codes, names = _name_codes(procedures['concept_name'])
+
+    per_rule = []
+    for rule in rules:
+        if rule['type'] == 'any':
+            mask = _match_procedures(procedures, codes, names, rule['match'])
+            per_rule.append(_grouped_day(person_id, day, mask, 'min'))
+
+        elif rule['type'] == 'followed_by':
+            first_mask = _match_procedures(procedures, codes, names, rule['first'])
+            then_mask = _match_procedures(procedures, codes, names, rule['then'])
+            earliest_first = _grouped_day(person_id, day, first_mask, 'min')
+
+            if rule.get('within_days') is None:
+                latest_then = _grouped_day(person_id, day, then_mask, 'max').rename_columns(['person_id', 'then_day'])
+                joined = earliest_first.join(latest_then, 'person_id', join_type='inner')
+                followed = joined.filter(pc.greater(joined['then_day'], joined['day']))['person_id']
+            else:
+                mask = pa.array(then_mask)
+                df_then = pa.table({'person_id': pc.filter(person_id, mask), 'then_day': pc.filter(day, mask)})
+                joined = df_then.join(earliest_first, 'person_id', join_type='inner')
+                gap = pc.subtract(joined['then_day'], joined['day'])
+                in_range = pc.and_(pc.greater(gap, 0), pc.less_equal(gap, rule['within_days']))
+                followed = joined.filter(in_range)['person_id']
+
+            per_rule.append(earliest_first.filter(pc.is_in(earliest_first['person_id'], pc.unique(followed))))
+
+        else:
+            raise ValueError(f"Unknown event rule type: {rule['type']}")
+
+    if not per_rule:
+        return pa.table({'person_id': pa.array([], person_id.type), 'day': pa.array([], pa.int32())})
+    events = pa.concat_tables(per_rule).group_by('person_id').aggregate([('day', 'min')])
+    return pa.table({'person_id': events['person_id'], 'day': events['day_min']})
+
+
+@instrumented()
+def make_dataframe_arrow(person, death, procedures, visits, rules=EVENT_RULES):
+    # make_dataframe on Arrow tables; output rows keep the person table's order
+    cohort = pa.table({
+        'person_id': person['person_id'],
+        'gender_concept_name': person['gender_concept_name'],
+        'year_of_birth': person['year_of_birth'],
+        'age': pc.subtract(2025, person['year_of_birth']),
+        '_row': pa.array(np.arange(person.num_rows)),
+    })
+
+    deaths = pa.table({'person_id': death['person_id'], 'death_day': _days(death['death_date'])})
+    all_visits = np.ones(visits.num_rows, dtype=bool)
+    first_visit = _grouped_day(visits['person_id'], _days(visits['visit_start_date']), all_visits, 'min')
+    first_visit = first_visit.rename_columns(['person_id', 'first_activity_day'])
+    last_visit = _grouped_day(visits['person_id'], _days(visits['visit_end_date']), all_visits, 'max')
+    last_visit = last_visit.rename_columns(['person_id', 'last_activity_day'])
+    events = event_days(procedures, rules).rename_columns(['person_id', 'event_day'])
+
+    cohort = cohort.join(deaths, 'person_id', join_type='left outer')
+    cohort = cohort.join(first_visit, 'person_id', join_type='left outer')
+    cohort = cohort.join(last_visit, 'person_id', join_type='left outer')
+    cohort = cohort.append_column('censor_day', pc.coalesce(cohort['death_day'], cohort['last_activity_day']))
+    cohort = cohort.filter(pc.is_valid(cohort['censor_day']))
+    cohort = cohort.join(events, 'person_id', join_type='left outer').sort_by('_row')
+
+    death_type = _date_type(death.schema.field('death_date').type)
+    start_type = _date_type(visits.schema.field('visit_start_date').type)
+    visit_type = _date_type(visits.schema.field('visit_end_date').type)
+    event_type = _date_type(procedures.schema.field('procedure_date').type)
+    censor_type = _finer(death_type, visit_type)
+    return pa.table({
+        'person_id': cohort['person_id'],
+        'gender_concept_name': cohort['gender_concept_name'],
+        'year_of_birth': cohort['year_of_birth'],
+        'age': cohort['age'],
+        'death_date': _dates(cohort['death_day'], death_type),
+        'first_activity_date': _dates(cohort['first_activity_day'], start_type),
+        'last_activity_date': _dates(cohort['last_activity_day'], visit_type),
+        'last_of_death_or_visit': _dates(cohort['censor_day'], censor_type),
+        'first_bone_event_date': _dates(cohort['event_day'], event_type),
+        'T_ref': _dates(pc.coalesce(cohort['event_day'], cohort['censor_day']), _finer(event_type, censor_type)),
+        'event_status': pc.cast(pc.is_valid(cohort['event_day']), pa.uint8()),
+    }).to_pandas(date_as_object=False)
+
+
+def load_cohort_arrow(tables):
+    # Build the cohort without leaving Arrow from the cohort tables, scanned
+    # with the pandas path's projections and filters (TABLE_SCANS)
+    return make_dataframe_arrow(tables['person'], tables['death'], tables['procedure_occurence'], tables['visit_occurence'])
+
+
+def _join_windows(table, df_features, windows=WINDOWS):
+    # windows.join_windows for an Arrow table with an int32 'day' column:
+    # the same searchsorted matching (window_positions), so each row is
+    # taken once per window it falls in and never joined against the other
+    # windows. Adds an int8 'window' code (position in windows) and the
+    # patient's reference day 'ref'; rows keep window_positions' order
+    days = table['day'].to_numpy().astype('datetime64[D]')
+    rows, persons, labels = window_positions(table['person_id'].to_numpy(), days, df_features, windows)
+    ref_day = reference_dates(df_features).to_numpy().astype('datetime64[D]').astype(np.int64)
+    return (
+        table.take(pa.array(rows))
+        .append_column('window', pa.array(labels))
+        .append_column('ref', pa.array(ref_day[persons]))
+    )
+
+
+def _cohort_rows(table, df_features, windows, day):
+    # Rows for cohort patients inside the cohort-wide window range (the scan
+    # filters are only pushed down when they fit the file schema)
+    min_date, max_date = window_date_range(df_features, windows)
+    lo, hi = (np.datetime64(d.date(), 'D').astype(np.int64) for d in (min_date, max_date))
+    keep = pc.and_(
+        pc.is_in(table['person_id'], pa.array(df_features['person_id'].unique()).cast(table.schema.field('person_id').type)),
+        pc.and_(pc.greater_equal(day, lo), pc.less_equal(day, hi))
+    )
+    return pc.fill_null(keep, False).to_numpy(zero_copy_only=False)
+
+
+@instrumented()
+def lab_first_last_arrow(df_features, measurement_path, windows=WINDOWS, labs=HIGH_FREQ_LABS):
+    # lab_first_last with the measurement table kept in Arrow: one window
+    # join and one multithreaded hash group-by. The join leaves rows ordered
+    # by (window, person, date, scan order), so first/last non-null value
+    # are the values at the smallest and largest such position in a group,
+    # which min/max find without an ordered (single-threaded) aggregation
+    scan = measurement_scan(df_features, windows, labs)
+    table = scan_table(measurement_path, scan['columns'], scan['filters'])
+
+    codes, names = _name_codes(table['concept_name'])
+    lab_of_name = pc.fill_null(pc.index_in(pa.array(names, pa.string()), value_set=pa.array(labs, pa.string())), -1)
+    lab = _per_row(codes, lab_of_name.to_numpy().astype(np.int16), -1)
+    day = _days(table['measurement_date'])
+    value = pc.cast(table['value_as_number'], pa.float64())
+    value = pc.if_else(pc.is_nan(value), pa.scalar(None, pa.float64()), value)
+
+    keep = pa.array((lab >= 0) & _cohort_rows(table, df_features, windows, day))
+    rows = pa.table({'person_id': table['person_id'], 'lab': pa.array(lab), 'day': day, 'value': value}).filter(keep)
+    print(f"Filtered to {rows.num_rows:,} measurements for {len(labs)} high-freq labs")
+
+    rows = _join_windows(rows, df_features, windows)
+    t = pc.cast(pc.subtract(rows['day'], rows['ref']), pa.float64())
+    t = pc.if_else(pc.is_valid(rows['value']), t, pa.scalar(None, pa.float64()))
+    position = pa.array(np.arange(rows.num_rows))
+    rows = rows.append_column('t', t).append_column('value_sq', pc.multiply(rows['value'], rows['value']))
+    rows = rows.append_column('tt', pc.multiply(t, t)).append_column('tv', pc.multiply(t, rows['value']))
+    rows = rows.append_column('position', pc.if_else(pc.is_valid(rows['value']), position, pa.scalar(None, pa.int64())))
+    window_counts = np.bincount(rows['window'].to_numpy(), minlength=len(windows))
+    print(' | '.join(f"{suffix} window: {n:,} records" for suffix, n in zip(windows, window_counts)))
+
+    keys = ['window', 'lab', 'person_id']
+    stats = (
+        rows.group_by(keys, use_threads=True)
+        .aggregate([
+            ([], 'count_all'), ('position', 'min'), ('position', 'max'), ('value', 'count'),
+            ('value', 'sum'), ('value_sq', 'sum'), ('t', 'sum'), ('tt', 'sum'), ('tv', 'sum'),
+            ('value', 'min'), ('value', 'max'), ('t', 'max'),
+        ])
+        .sort_by([(k, 'ascending') for k in keys])
+    )
+    stats = stats.append_column('value_first', rows['value'].take(stats['position_min']))
+    stats = stats.append_column('value_last', rows['value'].take(stats['position_max']))
+
+    def values(name, fill=None):
+        column = stats[name] if fill is None else pc.fill_null(stats[name], fill)
+        return column.to_numpy(zero_copy_only=False)
+
+    # The pandas path keeps first/last in the column's own dtype (float32
+    # after compaction) and computes the sums in float64
+    first_last_type = table.schema.field('value_as_number').type
+    out = pd.DataFrame({
+        'window': pd.Categorical.from_codes(values('window'), categories=list(windows)),
+        'concept_name': pd.Categorical.from_codes(values('lab'), dtype=lab_dtype(labs)),
+        'person_id': values('person_id'),
+        'n': values('count_all'),
+        'first_value': pc.cast(stats['value_first'], first_last_type).to_numpy(zero_copy_only=False),
+        'last_value': pc.cast(stats['value_last'], first_last_type).to_numpy(zero_copy_only=False),
+        'count': values('value_count'),
+        'sum': values('value_sum', 0.0), 'sum_sq': values('value_sq_sum', 0.0),
+        'sum_t': values('t_sum', 0.0), 'sum_tt': values('tt_sum', 0.0), 'sum_tv': values('tv_sum', 0.0),
+        'min': values('value_min'), 'max': values('value_max'), 'last_t': values('t_max'),
+    })
+    return out[LAB_STATS_COLUMNS]
+
+
+@instrumented()
+def drug_feature_block_arrow(df_features, drug_exposure_path, windows=WINDOWS, lookup_dir=None, categories=DRUG_CATEGORIES):
+    # drug_feature_block with the drug table kept in Arrow: names classified
+    # once per distinct name, then a window join and a grouped any()
+    scan = drug_exposure_scan(df_features, windows, categories)
+    table = scan_table(drug_exposure_path, scan['columns'], scan['filters'])
+
+    codes, names = _name_codes(table['concept_name'])
+    flags = classify_drug_names(pd.Series(names, dtype=object), lookup_dir, categories).to_numpy()
+    flags = np.vstack([flags, np.zeros((1, len(categories)), dtype=bool)])[codes]  # code -1 = missing name
+    day = _days(table['drug_exposure_start_date'])
+
+    keep = pa.array(flags.any(axis=1) & _cohort_rows(table, df_features, windows, day))
+    categories = list(categories)
+    drugs = pa.table({
+        'person_id': table['person_id'], 'day': day,
+        **{cat: pa.array(flags[:, i]) for i, cat in enumerate(categories)},
+    }).filter(keep)
+
+    exposed = (
+        _join_windows(drugs, df_features, windows)
+        .group_by(['person_id', 'window'])
+        .aggregate([(cat, 'any') for cat in categories])
+        .to_pandas()
+        .set_index(['person_id', 'window'])
+    )
+    columns = {}
+    for i, suffix in enumerate(windows):
+        in_window = exposed.xs(i, level='window') if len(exposed) else exposed
+        for cat in categories:
+            flag = in_window[f'{cat}_any'] if len(in_window) else pd.Series(dtype=bool)
+            columns[f'{cat}_{suffix}'] = df_features['person_id'].map(flag).fillna(0).astype(np.uint8)
+
+    return pd.DataFrame(columns, index=df_features.index)
+
+
+def mismatched_columns(df_a, df_b, rtol=1e-6):
+    # Column-for-column check between two feature tables (e.g. the pandas and
+    # arrow backends): names, order, dtypes and values, rows matched by position
+    if list(df_a.columns) != list(df_b.columns) or len(df_a) != len(df_b):
+        return sorted(set(df_a.columns) ^ set(df_b.columns)) or ['<shape>']
+
+    bad = []
+    for column in df_a.columns:
+        a, b = df_a[column], df_b[column]
+        if a.dtype != b.dtype:
+            bad.append(column)
+        elif a.dtype.kind == 'f':
+            if not np.allclose(a.to_numpy(), b.to_numpy(), rtol=rtol, atol=0, equal_nan=True):
+                bad.append(column)
+        elif not a.reset_index(drop=True).equals(b.reset_index(drop=True)):
+            bad.append(column)
+    return bad
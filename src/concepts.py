@@ -0,0 +1,103 @@
+import re
+import json
+from pathlib import Path
+from src.feature_store import stage_key
+
+# Concept dictionary: the name and ID lookups the feature stages derive from
+# the spec, built once instead of on every call --
+#   lab_columns:  lab name -> the safe name its feature columns start with
+#   drugs:        the drug scan's alternation pattern, one pattern per
+#                 category, and the category flags of every listed drug name
+#   event_ids:    the procedure concept IDs the event rules match on
+# Each section is memoized in the process under a key of its inputs.
+# load_data saves all of them as one JSON artifact under cache_dir
+# (concepts_{key}.json), and a later run seeds the memo from it in one read.
+# Compiled regexes are memoized the same way.
+
+_SECTIONS = {}
+_REGEXES = {}
+
+
+def safe_lab_name(lab_name):
+    return (lab_name.lower()
+            .replace(' ', '_').replace('/', '_').replace('[', '').replace(']', '')
+            .replace('(', '').replace(')', '').replace(',', '')[:25])
+
+
+def _key(name, inputs):
+    # Category order matters (flags are listed in it), so drugs are keyed as pairs
+    if isinstance(inputs, dict):
+        inputs = list(inputs.items())
+    return stage_key(name, list(inputs))
+
+
+def _section(name, inputs, build):
+    key = _key(name, inputs)
+    if key not in _SECTIONS:
+        _SECTIONS[key] = build()
+    return _SECTIONS[key]
+
+
+def _build_drugs(categories):
+    patterns = {cat: '|'.join(re.escape(d.lower()) for d in drugs) for cat, drugs in categories.items()}
+    regexes = {cat: re.compile(pattern) for cat, pattern in patterns.items()}
+    names = sorted({d for drugs in categories.values() for d in drugs})
+    return {
+        'pattern': '|'.join(patterns.values()),
+        'category_patterns': patterns,
+        'names': {name: [bool(regexes[cat].search(name.lower())) for cat in categories] for name in names},
+    }
+
+
+def _build_event_ids(rules):
+    return sorted({
+        int(i) for rule in rules for key in ('match', 'first', 'then')
+        for i in rule.get(key, {}).get('concept_ids', [])
+    })
+
+
+def lab_columns(labs):
+    return _section('lab_columns', labs, lambda: {lab: safe_lab_name(lab) for lab in labs})
+
+
+def drug_concepts(categories):
+    return _section('drugs', categories, lambda: _build_drugs(categories))
+
+
+def event_concept_ids(rules):
+    return _section('event_ids', rules, lambda: _build_event_ids(rules))
+
+
+def category_regexes(categories):
+    # {category: compiled pattern}, matched against lowercased concept names
+    key = _key('drugs', categories)
+    if key not in _REGEXES:
+        _REGEXES[key] = {cat: re.compile(p) for cat, p in drug_concepts(categories)['category_patterns'].items()}
+    return _REGEXES[key]
+
+
+def concept_dictionary_path(cache_dir, labs, categories, rules):
+    key = stage_key('concepts', list(labs), list(categories.items()), rules)
+    return Path(cache_dir) / f"concepts_{key}.json"
+
+
+def load_concept_dictionary(cache_dir, labs, categories, rules):
+    # Every section for this spec, from the artifact under cache_dir if there
+    # is one (written otherwise). Returns {section: value}
+    path = concept_dictionary_path(cache_dir, labs, categories, rules)
+    keys = {'lab_columns': _key('lab_columns', labs), 'drugs': _key('drugs', categories), 'event_ids': _key('event_ids', rules)}
+    if path.exists():
+        saved = json.loads(path.read_text())
+        _SECTIONS.update({keys[name]: value for name, value in saved.items()})
+        return saved
+
+    dictionary = {
+        'lab_columns': lab_columns(labs),
+        'drugs': drug_concepts(categories),
+        'event_ids': event_concept_ids(rules),
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(dictionary))
+    tmp.replace(path)
+    return dictionary
@@ -0,0 +1,124 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+from pathlib import Path
+from src.windows import reference_dates
+
+# Bump when stage outputs change shape so old cache files are not reused
+STORE_VERSION = 3
+
+
+def input_fingerprint(paths):
+    # Size and mtime of every file behind each input path (file or dataset folder)
+    entries = []
+    for path in paths:
+        path = Path(path)
+        files = sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [path]
+        for f in files:
+            if f.exists():
+                stat = f.stat()
+                entries.append([str(f), stat.st_size, stat.st_mtime_ns])
+            else:
+                entries.append([str(f), None, None])
+    return entries
+
+
+def stage_key(*parts):
+    # Hash of everything a stage depends on: input fingerprints and feature definitions
+    payload = json.dumps([STORE_VERSION, *parts], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+
+class FeatureStore:
+    # Parquet cache of pipeline stages under cache_dir/features, one file per
+    # (stage, key). With cache_dir=None every stage is simply computed.
+
+    def __init__(self, cache_dir=None):
+        self.root = Path(cache_dir) / 'features' if cache_dir is not None else None
+
+    def _path(self, name, key, suffix=''):
+        return self.root / f'{name}_{key}{suffix}.parquet'
+
+    def _write(self, df, path):
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        df.to_parquet(tmp, index=False)
+        tmp.replace(path)
+
+    def stage(self, name, key, compute):
+        # Load the stage if it was built with this key, otherwise compute and store it
+        if self.root is None:
+            return compute()
+
+        path = self._path(name, key)
+        if path.exists():
+            print(f"{name}: loaded from cache ({path.name})")
+            return pd.read_parquet(path)
+
+        df = compute()
+        self._write(df, path)
+        return df
+
+    def window_stage(self, name, keys, df_cohort, compute):
+        # Like stage, for outputs whose rows depend only on each patient's own
+        # windows, cached per window. keys maps each window to its key;
+        # compute(df_cohort_subset, window_names) returns {window: rows with a
+        # person_id column} for all requested windows in one pass, so the
+        # windows that need work share one scan. Under the same key, cached
+        # rows are kept for patients already covered with the same reference
+        # date: adding a window computes only that window, and patients new
+        # to the cohort (or with a moved reference date) are computed alone.
+        # The keys include the event files' fingerprints, so any change to
+        # those files (an append included) recomputes every patient; that
+        # case is src/incremental.py's.
+        if self.root is None:
+            return compute(df_cohort, list(keys))
+
+        current = pd.DataFrame({'person_id': df_cohort['person_id'], 'ref_date': reference_dates(df_cohort)})
+        cached, complete, todo = {}, {}, {}
+        for window, key in keys.items():
+            path = self._path(f'{name}_{window}', key)
+            persons_path = self._path(f'{name}_{window}', key, '.persons')
+            if path.exists() and persons_path.exists():
+                covered = pd.read_parquet(persons_path)
+                reused = current.merge(covered, on=['person_id', 'ref_date'], how='inner')['person_id']
+                rows = pd.read_parquet(path)
+                cached[window] = rows[rows['person_id'].isin(reused)]
+                complete[window] = len(reused) == len(covered)
+            else:
+                reused = pd.Series([], dtype=current['person_id'].dtype)
+                cached[window], complete[window] = None, False
+            todo[window] = ~df_cohort['person_id'].isin(reused).to_numpy()
+
+        needed = [window for window in keys if todo[window].any()]
+        computed = {}
+        if needed:
+            todo_any = np.logical_or.reduce([todo[window] for window in needed])
+            print(f"{name}: computing {', '.join(needed)} for {todo_any.sum():,} patients"
+                  f" ({len(keys) - len(needed)} of {len(keys)} windows fully cached)")
+            computed = compute(df_cohort[todo_any], needed)
+        else:
+            print(f"{name}: loaded from cache ({len(keys)} windows)")
+
+        out = {}
+        for window, key in keys.items():
+            if window not in needed and cached[window] is not None and complete[window]:
+                out[window] = cached[window].reset_index(drop=True)
+                continue
+            parts = [cached[window]] if cached[window] is not None else []
+            if window in computed:
+                # Computed for every patient any window needed; keep this window's own
+                new = computed[window]
+                parts.append(new[new['person_id'].isin(df_cohort['person_id'][todo[window]])])
+            out[window] = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame({'person_id': []})
+            self._write(out[window], self._path(f'{name}_{window}', key))
+            self._write(current, self._path(f'{name}_{window}', key, '.persons'))
+        return out
+
+    def latest(self, name):
+        # Most recently written file for a stage, e.g. the current features table for scoring
+        paths = [p for p in self.root.glob(f'{name}_*.parquet') if not p.name.endswith('.persons.parquet')]
+        if not paths:
+            raise FileNotFoundError(f"No cached '{name}' stage in {self.root}")
+        return max(paths, key=lambda p: p.stat().st_mtime_ns)
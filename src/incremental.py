@@ -0,0 +1,200 @@
+import pandas as pd
+import numpy as np
+import json
+from pathlib import Path
+from src.parquet_scan import read_table
+from src.instrument import instrumented
+from src.feature_store import input_fingerprint
+from src.windows import join_windows
+from src.make_dataframe import make_dataframe, TABLE_SCANS
+from src.add_measurement_features import lab_first_last, lab_feature_block, measurement_scan
+from src.add_drug_features import drug_feature_block, drug_exposure_scan
+from src.spec import SPEC
+
+# Daily refresh of a stored feature table from delta parquet files: new rows
+# since the last extract, in a folder laid out like FOLDER_PATH (any of
+# person, death, visit_occurence, procedure_occurence, measurement and
+# drug_exposure). Only patients whose features can change are rebuilt, from
+# their own history plus the delta, so the cost follows the delta rather
+# than the full tables.
+#
+# A patient is affected if they have a new cohort row (person, death, visit
+# or event procedure: any of these can move the reference date, and so every
+# window), or a new lab or drug row inside one of their current windows.
+# The feature columns stay those of the stored table; a lab that would cross
+# the cohort-wide row threshold only appears after a full load_data.
+
+COHORT_TABLES = ['person', 'death', 'visit_occurence', 'procedure_occurence']
+
+# Each table's row id, used to drop rows the extract and the delta both have
+ROW_IDS = {
+    'person': 'person_id',
+    'death': 'person_id',
+    'visit_occurence': 'visit_occurrence_id',
+    'procedure_occurence': 'procedure_occurrence_id',
+    'measurement': 'measurement_id',
+    'drug_exposure': 'drug_exposure_id',
+}
+
+
+def _table_path(folder, name):
+    return Path.home() / folder / f'{name}.parquet'
+
+
+def _read(folder, name, scan, person_ids=None):
+    # read_table with the stage's scan, optionally restricted to person_ids;
+    # None if the folder has no such table (deltas rarely have all of them)
+    path = _table_path(folder, name)
+    if not path.exists():
+        return None
+    filters = scan.get('filters')
+    if person_ids is not None:
+        condition = ('person_id', 'in', np.asarray(person_ids))
+        if not filters:
+            filters = [condition]
+        elif isinstance(filters[0], tuple):
+            filters = filters + [condition]
+        else:
+            # OR of conjunctions (the procedure event rules): add it to each
+            filters = [conjunction + [condition] for conjunction in filters]
+    return read_table(path, scan.get('columns'), filters)
+
+
+def _history(folder, delta_path, name, scan, person_ids=None):
+    # The table's rows for person_ids from the full extract plus the delta.
+    # Rows already merged into the extract are not counted twice: they are
+    # matched on the table's row id (the delta's copy wins). Without the id
+    # column every row is kept, since identical rows can be genuine repeats
+    row_id = ROW_IDS[name]
+    columns = scan.get('columns')
+    if columns is not None and row_id not in columns:
+        scan = {**scan, 'columns': columns + [row_id]}
+    frames = [df for df in (_read(folder, name, scan, person_ids), _read(delta_path, name, scan, person_ids)) if df is not None]
+    if not frames:
+        raise FileNotFoundError(f"{name}.parquet not found in {folder} or {delta_path}")
+    df = pd.concat(frames, ignore_index=True)
+    if all(row_id in frame.columns for frame in frames):
+        df = df.drop_duplicates(subset=row_id, keep='last', ignore_index=True)
+    if columns is not None and row_id not in columns:
+        df = df.drop(columns=row_id, errors='ignore')
+    return df
+
+
+def affected_persons(df_stored, delta_path, windows, labs, categories):
+    # person_ids whose features can change with this delta
+    affected = set()
+    for name in COHORT_TABLES:
+        df = _read(delta_path, name, TABLE_SCANS[name])
+        if df is not None:
+            affected.update(df['person_id'].unique().tolist())
+
+    event_scans = {
+        'measurement': (lambda df: measurement_scan(df, windows, labs), 'measurement_date'),
+        'drug_exposure': (lambda df: drug_exposure_scan(df, windows, categories), 'drug_exposure_start_date'),
+    }
+    for name, (scan, date_col) in event_scans.items():
+        if not _table_path(delta_path, name).exists():
+            continue
+        # Only rows inside a stored patient's current windows matter
+        ids = pd.read_parquet(_table_path(delta_path, name), columns=['person_id'])['person_id'].unique()
+        df_persons = df_stored[df_stored['person_id'].isin(ids)]
+        if df_persons.empty:
+            continue
+        df = _read(delta_path, name, scan(df_persons))
+        affected.update(join_windows(df, df_persons, date_col, windows)['person_id'].unique().tolist())
+    return np.array(sorted(affected), dtype=np.int64)
+
+
+def rebuild_persons(FOLDER_PATH, delta_path, person_ids, df_stored, spec=None, cache_dir=None):
+    # load_data's cohort, lab and drug stages for person_ids only, shaped like
+    # df_stored (same columns and dtypes). Patients who drop out of the cohort
+    # (no death or visit date) have no row
+    tables = {name: _history(FOLDER_PATH, delta_path, name, TABLE_SCANS[name], person_ids) for name in COHORT_TABLES}
+
+    df_features = make_dataframe(
+        tables['person'], tables['death'],
+        df_measurement=None, df_drug_exposure=None, df_condition_occurrence=None,
+        df_procedure_occurrence=tables['procedure_occurence'], df_visit_occurrence=tables['visit_occurence']
+    )
+    df_features['T_ref'] = pd.to_datetime(df_features['first_bone_event_date'].fillna(df_features['last_of_death_or_visit']))
+
+    def read(name, scan):
+        return _history(FOLDER_PATH, delta_path, name, scan)
+
+    return window_features(df_features, read, df_stored, spec, cache_dir)
+
+
+def window_features(df_features, read, df_stored, spec=None, cache_dir=None):
+    # The lab and drug features of a cohort frame (person_id and the dates
+    # reference_dates reads), added to it and shaped like df_stored (same
+    # columns and dtypes). read(name, scan) returns the measurement or
+    # drug_exposure rows for a scan; the scans already restrict to the
+    # cohort and its windows
+    spec = spec or SPEC
+    windows, labs, categories = spec['horizons'], spec['labs'], spec['drug_categories']
+    df_measurement = read('measurement', measurement_scan(df_features, windows, labs))
+    lab_stats = lab_first_last(df_features, df_measurement, windows, labs)
+    # Every lab is kept here; the stored table decides which columns exist
+    lab_block = lab_feature_block(
+        df_features['person_id'], lab_stats, windows, labs, spec['lab_aggregations'], spec['lab_fill_value'], min_rows=1
+    )
+
+    df_drug_exposure = read('drug_exposure', drug_exposure_scan(df_features, windows, categories))
+    drug_block = drug_feature_block(df_features, df_drug_exposure, windows, cache_dir, categories)
+
+    # Stored lab columns none of these patients have get the usual fill
+    df_new = pd.concat([df_features, lab_block, drug_block], axis=1).reindex(columns=df_stored.columns)
+    if spec['lab_fill_value'] is not None:
+        lab_cols = [c for c in df_stored.columns if c not in df_features.columns and c not in drug_block.columns]
+        df_new[lab_cols] = df_new[lab_cols].fillna(spec['lab_fill_value'])
+    return df_new.astype({c: t for c, t in df_stored.dtypes.items() if not isinstance(t, pd.CategoricalDtype)})
+
+
+def applied_deltas_path(features_path):
+    # Record of the delta folders already applied to features_path
+    return Path(features_path).with_suffix('.deltas.json')
+
+
+@instrumented()
+def refresh_features(FOLDER_PATH, delta_path, features_path, spec=None, cache_dir=None):
+    # Apply one delta folder to the feature table at features_path (written
+    # by a full run) in place. Returns the rebuilt rows and the person_ids
+    # updated (including any that left the cohort), for rescoring. A delta
+    # whose files were already applied is skipped.
+    spec = spec or SPEC
+    windows = spec['horizons']
+    features_path = Path(features_path)
+
+    applied_path = applied_deltas_path(features_path)
+    applied = json.loads(applied_path.read_text()) if applied_path.exists() else []
+    delta_dir = Path.home() / delta_path
+    if not delta_dir.is_dir():
+        raise FileNotFoundError(f"Delta folder {delta_dir} not found")
+    fingerprint = input_fingerprint([delta_dir])
+    if fingerprint in applied:
+        print(f'Delta {delta_path} already applied to {features_path}')
+        return None, np.array([], dtype=np.int64)
+
+    df_stored = pd.read_parquet(features_path)
+    person_ids = affected_persons(df_stored, delta_path, windows, spec['labs'], spec['drug_categories'])
+    print(f'{len(person_ids):,} of {len(df_stored):,} patients affected by {delta_path}')
+    if not len(person_ids):
+        applied_path.write_text(json.dumps(applied + [fingerprint]))
+        return df_stored.iloc[:0], person_ids
+
+    df_new = rebuild_persons(FOLDER_PATH, delta_path, person_ids, df_stored, spec, cache_dir)
+
+    # Rebuilt rows take their old place; patients new to the cohort go last
+    df_updated = pd.concat([df_stored[~df_stored['person_id'].isin(person_ids)], df_new], ignore_index=True)
+    position = pd.Index(df_stored['person_id']).get_indexer(df_updated['person_id'])
+    position[position < 0] = len(df_stored)
+    df_updated = df_updated.iloc[np.argsort(position, kind='stable')].reset_index(drop=True)
+    for c, t in df_stored.dtypes.items():
+        if isinstance(t, pd.CategoricalDtype):
+            df_updated[c] = df_updated[c].astype('category')
+
+    tmp = features_path.with_suffix('.tmp')
+    df_updated.to_parquet(tmp, index=False)
+    tmp.replace(features_path)
+    applied_path.write_text(json.dumps(applied + [fingerprint]))
+    return df_new, person_ids
@@ -0,0 +1,129 @@
+import pandas as pd
+import cProfile
+import functools
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Completed stages, in the order they finished
+RECORDS = []
+
+# Open stage names per thread; stages opened on worker threads (e.g. the
+# parallel table reads) nest under the main thread's innermost stage
+_main_stack = []
+_local = threading.local()
+_profile = {'stage': None, 'out_dir': None}
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, kilobytes on Linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def _rows(obj):
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return len(obj)
+    if isinstance(obj, (tuple, list)):
+        counts = [_rows(o) for o in obj]
+        counts = [c for c in counts if c is not None]
+        return sum(counts) if counts else None
+    return None
+
+
+def _stack():
+    if threading.current_thread() is threading.main_thread():
+        return _main_stack
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def enable_profiling(stage_name, out_dir='.'):
+    # Dump cProfile stats and a tracemalloc top-allocations list for one named stage
+    _profile['stage'] = stage_name
+    _profile['out_dir'] = Path(out_dir)
+
+
+def reset():
+    RECORDS.clear()
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    # Time a block: wall, CPU, peak RSS and row counts. Set record['rows_out']
+    # on the yielded dict to report output rows. CPU is the whole process's
+    # on the main thread, but only the calling thread's on a worker thread,
+    # where process time would count the other threads' work too
+    stack = _stack()
+    cpu_time = time.process_time if threading.current_thread() is threading.main_thread() else time.thread_time
+    parent = stack[-1] if stack else _main_stack[-1] if _main_stack else None
+    record = {'stage': name, 'parent': parent, 'rows_in': rows_in, 'rows_out': None}
+    profiling = _profile['stage'] == name
+    if profiling:
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        profiler.enable()
+
+    stack.append(name)
+    rss_before = _peak_rss_mb()
+    wall, cpu = time.perf_counter(), cpu_time()
+    try:
+        yield record
+    finally:
+        record['wall_s'] = round(time.perf_counter() - wall, 4)
+        record['cpu_s'] = round(cpu_time() - cpu, 4)
+        rss_after = _peak_rss_mb()
+        record['peak_rss_mb'] = round(rss_after, 1) if rss_after is not None else None
+        record['peak_rss_growth_mb'] = round(rss_after - rss_before, 1) if rss_after is not None else None
+        stack.pop()
+
+        if profiling:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            out_dir = _profile['out_dir']
+            out_dir.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(out_dir / f'{name}.prof')
+            with open(out_dir / f'{name}.tracemalloc.txt', 'w') as f:
+                for stat in snapshot.statistics('lineno')[:50]:
+                    f.write(f'{stat}\n')
+            record['profile'] = str(out_dir / f'{name}.prof')
+
+        RECORDS.append(record)
+
+
+def instrumented(name=None):
+    # Decorator form of stage(); rows in/out are the lengths of DataFrame
+    # arguments and of the returned frame(s)
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name, rows_in=_rows(list(args) + list(kwargs.values()))) as record:
+                result = func(*args, **kwargs)
+                record['rows_out'] = _rows(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def report(path=None):
+    # Structured report of every stage recorded so far; written as JSON if path is given
+    out = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'stages': list(RECORDS)}
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(out, f, indent=2)
+    return out
@@ -0,0 +1,48 @@
+import pandas as pd
+from pathlib import Path
+from src.parquet_scan import read_table
+from src.incremental import window_features
+from src.spec import SPEC
+
+# Landmark table for the survival models (models/survival.py). Each
+# patient's landmark is landmark_days after their first visit; patients
+# whose reference date (event or censoring) falls after it are at risk
+# there, the rest are left out. Their lab and drug window features are
+# rebuilt with the landmark as the reference date, so the covariates only
+# use rows from before the landmark, and follow-up runs from the landmark
+# to T_ref. Scored on the usual feature table, the reference date plays the
+# landmark: risk is read from there on.
+
+
+def landmark_dates(df_features, landmark_days):
+    return pd.to_datetime(df_features['first_activity_date']) + pd.Timedelta(days=landmark_days)
+
+
+def landmark_table(FOLDER_PATH, df_features, spec=None, cache_dir=None):
+    # load_data's feature table (same columns and dtypes) for the patients at
+    # risk at their landmark, with features as of the landmark, plus
+    # landmark_date and follow_up_days (landmark to T_ref)
+    spec = spec or SPEC
+    windows = spec['horizons']
+    landmark = landmark_dates(df_features, spec['landmark_days'])
+    at_risk = (pd.to_datetime(df_features['T_ref']) > landmark).to_numpy()
+
+    cohort_cols = [c for c in df_features.columns if not any(c.endswith(f'_{h}') for h in windows)]
+    df_cohort = df_features.loc[at_risk, cohort_cols].reset_index(drop=True)
+    df_cohort['landmark_date'] = landmark[at_risk].to_numpy()
+    print(f'{len(df_cohort):,} of {len(df_features):,} patients at risk at their landmark '
+          f'({spec["landmark_days"]} days after the first visit)')
+
+    # reference_dates reads first_bone_event_date, then last_of_death_or_visit
+    df_reference = df_cohort.assign(first_bone_event_date=pd.NaT, last_of_death_or_visit=df_cohort['landmark_date'])
+
+    def read(name, scan):
+        return read_table(Path.home() / FOLDER_PATH / f'{name}.parquet', scan.get('columns'), scan.get('filters'))
+
+    df_landmark = window_features(df_reference, read, df_features, spec, cache_dir).copy()
+    return df_landmark.assign(
+        first_bone_event_date=df_cohort['first_bone_event_date'],
+        last_of_death_or_visit=df_cohort['last_of_death_or_visit'],
+        landmark_date=df_cohort['landmark_date'],
+        follow_up_days=(pd.to_datetime(df_cohort['T_ref']) - df_cohort['landmark_date']).dt.days,
+    )
@@ -1,40 +1,176 @@
-import dask.dataframe as dd
 import pandas as pd
-import numpy as np
 from pathlib import Path
-from src.make_dataframe import make_dataframe
-from src.add_measurement_features import add_measurement_features
-from src.add_drug_features import add_drug_features
+from concurrent.futures import ThreadPoolExecutor
+from src.parquet_scan import read_tables, require_tables
+from src.instrument import instrumented
+from src.feature_store import FeatureStore, input_fingerprint, stage_key
+from src.make_dataframe import make_dataframe, TABLE_SCANS, EVENT_RULES
+from src.add_measurement_features import lab_first_last, lab_first_last_streaming, lab_feature_block, lab_feature_sparse, measurement_scan
+from src.add_drug_features import classify_drug_names, drug_feature_block, drug_exposure_scan
+from src.arrow_backend import load_cohort_arrow, lab_first_last_arrow, drug_feature_block_arrow
+from src.shards import map_shards
+from src.concepts import load_concept_dictionary
+from src.spec import SPEC
 
-def load_data(FOLDER_PATH):
+BACKENDS = ('pandas', 'arrow')
+
+
+@instrumented()
+def load_data(FOLDER_PATH, streaming=False, cache_dir=None, backend='pandas', n_jobs=None, spec=None, sparse=False,
+              cohort_only=False):
+    # spec (default src/spec.py SPEC) sets the horizons, labs, lab
+    # aggregations and drug categories. backend='arrow' builds the cohort, lab
+    # and drug stages in Arrow (see src/arrow_backend.py); the output is the
+    # same feature table. With n_jobs > 1 the pandas lab and drug stages run
+    # on person-hashed shards in a pool of n_jobs processes (see
+    # src/shards.py); Arrow already uses every core on its own.
+    # sparse=True returns (df_features without the lab block, lab block as
+    # lab_feature_sparse matrices) for models.common.sparse_design_matrix.
+    # cohort_only=True stops after the (cached) cohort stage: one row per
+    # patient with reference and event dates, no lab or drug features
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+    if streaming and backend != 'pandas':
+        raise ValueError("streaming is only supported by the pandas backend")
+
+    spec = spec or SPEC
+    windows, labs, categories = spec['horizons'], spec['labs'], spec['drug_categories']
+    if cache_dir is not None:
+        # Lab column names and drug patterns from the saved concept dictionary
+        load_concept_dictionary(cache_dir, labs, categories, EVENT_RULES)
 
     def path_for(name):
         p = name if name.endswith('.parquet') else f"{name}.parquet"
         return Path.home() / FOLDER_PATH / p
 
-    def load_dd(name):
-        return dd.read_parquet(path_for(name), engine='pyarrow')
+    # Every input this run reads must exist; all missing files are reported
+    # at once, before any work (or cache lookup) starts
+    inputs = list(TABLE_SCANS) + ([] if cohort_only else ['measurement', 'drug_exposure'])
+    require_tables({name: path_for(name) for name in inputs})
+
+    sharded = n_jobs is not None and n_jobs > 1
+
+    def load_frame(name, scan=None):
+        return read_tables({name: (path_for(name), scan or {})})[name]
+
+    def build_cohort():
+        # The four cohort tables are read concurrently (see read_tables)
+        print('Loading files...')
+        scans = {name: (path_for(name), scan) for name, scan in TABLE_SCANS.items()}
+        if backend == 'arrow':
+            return load_cohort_arrow(read_tables(scans, as_arrow=True))
+
+        tables = read_tables(scans)
+        # make_dataframe doesn't read measurements, drugs or conditions; the event
+        # tables are loaded afterwards, restricted to the cohort and its windows
+        return make_dataframe(
+            tables['person'], tables['death'],
+            df_measurement=None, df_drug_exposure=None, df_condition_occurrence=None,
+            df_procedure_occurrence=tables['procedure_occurence'], df_visit_occurrence=tables['visit_occurence']
+        )
+
+    # Lab and drug stages are built for any subset of the horizons at once,
+    # sharing one scan, and split per horizon for the feature store
+
+    def build_labs(df_cohort, horizons):
+        needed = {h: windows[h] for h in horizons}
+        if backend == 'arrow':
+            lab_stats = lab_first_last_arrow(df_cohort, path_for('measurement'), needed, labs)
+        elif streaming:
+            # Walk the measurement table in batches instead of materializing it
+            lab_stats = lab_first_last_streaming(df_cohort, path_for('measurement'), needed, labs=labs)
+        else:
+            df_measurement = load_frame('measurement', measurement_scan(df_cohort, needed, labs))
+            if sharded and len(df_cohort):
+                # Long per-shard tables concatenate; the >=20 threshold is applied cohort-wide later
+                parts = map_shards(lab_first_last, df_cohort, [df_measurement], n_jobs, needed, labs)
+                lab_stats = pd.concat(parts, ignore_index=True)
+            else:
+                lab_stats = lab_first_last(df_cohort, df_measurement, needed, labs)
+        return {h: lab_stats[lab_stats['window'] == h] for h in horizons}
+
+    def build_drugs(df_cohort, horizons):
+        needed = {h: windows[h] for h in horizons}
+        if backend == 'arrow':
+            block = drug_feature_block_arrow(df_cohort, path_for('drug_exposure'), needed, cache_dir, categories)
+        else:
+            df_drug_exposure = load_frame('drug_exposure', drug_exposure_scan(df_cohort, needed, categories))
+            if sharded and len(df_cohort):
+                if cache_dir is not None:
+                    # Fill the persistent lookup once here, so shards only read it
+                    classify_drug_names(df_drug_exposure['concept_name'], cache_dir, categories)
+                parts = map_shards(drug_feature_block, df_cohort, [df_drug_exposure], n_jobs, needed, cache_dir, categories)
+                block = pd.concat(parts).reindex(df_cohort.index)
+            else:
+                block = drug_feature_block(df_cohort, df_drug_exposure, needed, cache_dir, categories)
+        return {
+            h: pd.concat([df_cohort[['person_id']], block[[f'{cat}_{h}' for cat in categories]]], axis=1)
+            for h in horizons
+        }
+
+    # Each stage is cached under a key of its input files and feature
+    # definitions; lab and drug stages get one key per horizon. The lab and
+    # drug keys cover the whole measurement and drug_exposure files, so
+    # appending to either rebuilds that stage for every patient
+    store = FeatureStore(cache_dir)
+    cohort_key = stage_key(
+        'cohort', input_fingerprint(path_for(name) for name in TABLE_SCANS), TABLE_SCANS, EVENT_RULES
+    )
+
+    def cohort_stage():
+        df_features = store.stage('cohort', cohort_key, build_cohort)
+        df_features['T_ref'] = pd.to_datetime(df_features['first_bone_event_date'].fillna(df_features['last_of_death_or_visit']))
+        return df_features
+
+    if cohort_only:
+        return cohort_stage()
+
+    measurement_files = input_fingerprint([path_for('measurement')])
+    drug_files = input_fingerprint([path_for('drug_exposure')])
+    labs_keys = {h: stage_key('labs', measurement_files, labs, {h: days}) for h, days in windows.items()}
+    drugs_keys = {h: stage_key('drugs', drug_files, categories, {h: days}) for h, days in windows.items()}
+
+    def build_stages():
+        # Cohort, long lab stats and the drug block, each from its own cache.
+        # The lab and drug stages run side by side on threads, so the
+        # measurement and drug_exposure scans overlap. When sharded they run
+        # one after the other on the main thread: each shard pool already
+        # uses every core, and process pools are started from the main thread
+        df_features = cohort_stage()
+        person_ids = df_features['person_id']
 
-    def load_frame(name):
-        return load_dd(name).compute()
-    
-    print('Loading files...')
+        if sharded:
+            lab_stats = store.window_stage('labs', labs_keys, df_features, build_labs)
+            drug_blocks = store.window_stage('drugs', drugs_keys, df_features, build_drugs)
+        else:
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                lab_future = pool.submit(store.window_stage, 'labs', labs_keys, df_features, build_labs)
+                drug_future = pool.submit(store.window_stage, 'drugs', drugs_keys, df_features, build_drugs)
+                lab_stats, drug_blocks = lab_future.result(), drug_future.result()
 
-    try:
-        df_person = load_frame('person')
-        df_death = load_frame('death')
-        df_measurement = load_frame('measurement')
-        df_drug_exposure = load_frame('drug_exposure')
-        df_condition_occurrence = load_frame('condition_occurrence')
-        df_procedure_occurrence = load_frame('procedure_occurence')
-        df_visit_occurrence = load_frame('visit_occurence')
-        print('Done. Dataframes available: df_person, df_death, df_measurement, df_drug_exposure, df_condition_occurrence, df_procedure_occurrence, df_visit_occurrence')
-    except Exception as e:
-        print('Error when loading — check FOLDER_PATH and that parquet files exist:', e)
+        lab_stats = pd.concat(lab_stats.values(), ignore_index=True)
+        lab_stats['window'] = lab_stats['window'].astype(pd.CategoricalDtype(list(windows)))
+        drug_block = pd.concat(
+            [drug_blocks[h].set_index('person_id').reindex(person_ids).set_axis(df_features.index) for h in windows],
+            axis=1
+        )
+        return df_features, lab_stats, drug_block
 
-    df_features = make_dataframe(df_person, df_death, df_measurement, df_drug_exposure, df_condition_occurrence, df_procedure_occurrence, df_visit_occurrence)
-    df_features = add_measurement_features(df_features, df_measurement)
-    df_features = add_drug_features(df_features, df_drug_exposure)
-    return df_features
+    if sparse:
+        # The wide lab block is never materialised; pivoting the cached long
+        # stats into CSR is cheap, so the result isn't cached itself
+        df_features, lab_stats, drug_block = build_stages()
+        lab_block = lab_feature_sparse(df_features['person_id'], lab_stats, windows, labs, spec['lab_aggregations'])
+        return pd.concat([df_features, drug_block], axis=1), lab_block
 
+    def build_features():
+        df_features, lab_stats, drug_block = build_stages()
+        lab_block = lab_feature_block(
+            df_features['person_id'], lab_stats, windows, labs, spec['lab_aggregations'], spec['lab_fill_value']
+        )
+        return pd.concat([df_features, lab_block, drug_block], axis=1)
 
+    features_key = stage_key(
+        'features', cohort_key, labs_keys, drugs_keys, spec['lab_aggregations'], spec['lab_fill_value']
+    )
+    return store.stage('features', features_key, build_features)
@@ -1,14 +1,113 @@
 import pandas as pd
 import numpy as np
+from src.instrument import instrumented
 
 EVENT_IDS = [2110698, 2110700, 2110701, 2110699, 2110696, 2110697, 
              2768451, 2103473, 2103475, 2104914, 2105150, 
              46257752, 46257753, 46257748, 2769730, 2765699]
 
+FRACTURE_PATTERN = 'pathologic fracture|bone fracture|vertebral fracture'
+RADIATION_PATTERN = 'radiation|radiotherapy'
+
+# Outcome definitions; a patient's event date is the earliest date any rule fires.
+# Each rule matches procedures by 'pattern' (case-insensitive regex on concept_name)
+# and/or 'concept_ids' (procedure_concept_id list).
+#   'any':         every matching procedure is an event
+#   'followed_by': the earliest 'first' procedure is an event if some 'then'
+#                  procedure comes after it (within 'within_days' days, if set)
+EVENT_RULES = [
+    # Cross-reference approach: fracture assessment AND radiation therapy after it
+    {'type': 'followed_by', 'first': {'pattern': FRACTURE_PATTERN}, 'then': {'pattern': RADIATION_PATTERN}},
+    # Original EVENT_IDS
+    {'type': 'any', 'match': {'concept_ids': EVENT_IDS}},
+]
+
+
+def _rule_filters(rules):
+    # One DNF disjunct per match spec, so the procedure scan keeps any row a rule could use
+    filters = []
+    for rule in rules:
+        for key in ('match', 'first', 'then'):
+            if key not in rule:
+                continue
+            if 'pattern' in rule[key]:
+                filters.append([('concept_name', 'match', rule[key]['pattern'])])
+            if 'concept_ids' in rule[key]:
+                filters.append([('procedure_concept_id', 'in', rule[key]['concept_ids'])])
+    return filters
+
+
+# Columns and row filters make_dataframe needs from each table (pushed down by load_data)
+TABLE_SCANS = {
+    'person': {'columns': ['person_id', 'gender_concept_name', 'year_of_birth']},
+    'death': {'columns': ['person_id', 'death_date']},
+    'visit_occurence': {'columns': ['person_id', 'visit_start_date', 'visit_end_date']},
+    'procedure_occurence': {
+        'columns': ['person_id', 'procedure_concept_id', 'concept_name', 'procedure_date'],
+        'filters': _rule_filters(EVENT_RULES),
+    },
+}
+
+
+def _match_procedures(df_procedure_occurrence, match):
+    mask = np.zeros(len(df_procedure_occurrence), dtype=bool)
+    if 'pattern' in match:
+        # Match each distinct concept name once
+        codes, names = pd.factorize(df_procedure_occurrence['concept_name'])
+        hits = pd.Series(names, dtype=object).str.contains(match['pattern'], case=False, na=False).to_numpy()
+        mask |= np.append(hits, False)[codes]
+    if 'concept_ids' in match:
+        mask |= df_procedure_occurrence['procedure_concept_id'].isin(match['concept_ids']).to_numpy()
+    return mask
+
+
+@instrumented()
+def event_dates(df_procedure_occurrence, rules=EVENT_RULES):
+    # Earliest event date per person_id over all rules, computed with grouped
+    # min/max and joins rather than per-patient loops
+    person_id = df_procedure_occurrence['person_id']
+    dates = pd.to_datetime(df_procedure_occurrence['procedure_date'], errors='coerce')
+
+    per_rule = []
+    for rule in rules:
+        if rule['type'] == 'any':
+            mask = _match_procedures(df_procedure_occurrence, rule['match'])
+            per_rule.append(dates[mask].groupby(person_id[mask]).min())
+
+        elif rule['type'] == 'followed_by':
+            first_mask = _match_procedures(df_procedure_occurrence, rule['first'])
+            then_mask = _match_procedures(df_procedure_occurrence, rule['then'])
+            earliest_first = dates[first_mask].groupby(person_id[first_mask]).min()
+
+            if rule.get('within_days') is None:
+                # Some 'then' after the earliest 'first' <=> latest 'then' is after it
+                latest_then = dates[then_mask].groupby(person_id[then_mask]).max()
+                followed = latest_then.reindex(earliest_first.index) > earliest_first
+            else:
+                df_then = pd.DataFrame({'person_id': person_id[then_mask], 'then_date': dates[then_mask]})
+                df_then = df_then.merge(earliest_first.rename('first_date'), left_on='person_id', right_index=True)
+                gap = df_then['then_date'] - df_then['first_date']
+                in_range = (gap > pd.Timedelta(0)) & (gap <= pd.Timedelta(days=rule['within_days']))
+                followed = earliest_first.index.isin(df_then.loc[in_range, 'person_id'])
+
+            per_rule.append(earliest_first[np.asarray(followed, dtype=bool)])
+
+        else:
+            raise ValueError(f"Unknown event rule type: {rule['type']}")
+
+    if not per_rule:
+        return pd.Series(dtype='datetime64[ns]', name='first_bone_event_date')
+    return pd.concat(per_rule).groupby(level=0).min().rename('first_bone_event_date')
+
+
+@instrumented()
 def make_dataframe(df_person, df_death, df_measurement, df_drug_exposure, df_condition_occurrence, df_procedure_occurrence, df_visit_occurrence):
-    # Define date of last visit
-    df_last_visit = df_visit_occurrence.groupby('person_id')['visit_end_date'].max().reset_index()
-    df_last_visit.rename(columns={'visit_end_date': 'last_activity_date'}, inplace=True)
+    # Define dates of first and last visit (the first is the survival models' time origin)
+    df_last_visit = df_visit_occurrence.groupby('person_id').agg(
+        first_activity_date=('visit_start_date', 'min'),
+        last_activity_date=('visit_end_date', 'max'),
+    ).reset_index()
+    df_last_visit['first_activity_date'] = pd.to_datetime(df_last_visit['first_activity_date'], errors='coerce')
     df_last_visit['last_activity_date'] = pd.to_datetime(df_last_visit['last_activity_date'], errors='coerce')
 
     # Define basic person info
@@ -28,52 +127,8 @@ def make_dataframe(df_person, df_death, df_measurement, df_drug_exposure, df_con
 
     df_features.dropna(subset=['last_of_death_or_visit'], inplace=True) # DROPS 164 PATIENTS HERE
 
-    # Cross-reference approach: patients with fracture assessment AND radiation therapy after it
-    bone_fracture_procedures = df_procedure_occurrence[
-        df_procedure_occurrence['concept_name'].str.contains('pathologic fracture|bone fracture|vertebral fracture', case=False, na=False)
-    ].copy()
-    bone_fracture_procedures['event_date'] = pd.to_datetime(bone_fracture_procedures['procedure_date'], errors='coerce')
-    
-    radiation_procedures = df_procedure_occurrence[
-        df_procedure_occurrence['concept_name'].str.contains('radiation|radiotherapy', case=False, na=False)
-    ].copy()
-    radiation_procedures['event_date'] = pd.to_datetime(radiation_procedures['procedure_date'], errors='coerce')
-    
-    # Find patients with fracture AND some radiation after the fracture
-    fracture_plus_radiation_patients = set()
-    for patient in set(bone_fracture_procedures['person_id']):
-        if patient in set(radiation_procedures['person_id']):
-            patient_fractures = bone_fracture_procedures[bone_fracture_procedures['person_id'] == patient]['event_date']
-            patient_radiation = radiation_procedures[radiation_procedures['person_id'] == patient]['event_date']
-            
-            earliest_fracture = patient_fractures.min()
-            # Check if ANY radiation occurs after the fracture
-            if any(rad_date > earliest_fracture for rad_date in patient_radiation):
-                fracture_plus_radiation_patients.add(patient)
-    
-    # Also include patients with original EVENT_IDS
-    event_id_procedures = df_procedure_occurrence[df_procedure_occurrence['procedure_concept_id'].isin(EVENT_IDS)].copy()
-    event_id_patients = set(event_id_procedures['person_id'])
-    
-    # Combine both groups of event patients
-    all_event_patients = fracture_plus_radiation_patients.union(event_id_patients)
-    
-    if len(all_event_patients) > 0:
-        # For cross-reference patients: use fracture assessment dates
-        cross_ref_procedures = bone_fracture_procedures[
-            bone_fracture_procedures['person_id'].isin(fracture_plus_radiation_patients)
-        ].copy()
-        
-        # Add EVENT_IDS procedures
-        event_id_procedures['event_date'] = pd.to_datetime(event_id_procedures['procedure_date'], errors='coerce')
-        
-        # Combine all event procedures
-        df_proc_mets = pd.concat([cross_ref_procedures, event_id_procedures]).drop_duplicates()
-    else:
-        df_proc_mets = pd.DataFrame(columns=['person_id', 'procedure_date'])
-
-    df_earliest_bone_event = df_proc_mets.groupby('person_id')['event_date'].min().reset_index()
-    df_earliest_bone_event.rename(columns={'event_date': 'first_bone_event_date'}, inplace=True)
+    # Earliest bone event per patient (see EVENT_RULES)
+    df_earliest_bone_event = event_dates(df_procedure_occurrence).rename_axis('person_id').reset_index()
 
     # Merge event date into the feature table
     df_features = df_features.merge(df_earliest_bone_event, on='person_id', how='left')
@@ -86,6 +141,6 @@ def make_dataframe(df_person, df_death, df_measurement, df_drug_exposure, df_con
     )
 
     # Define Event Status: 1 if bone event occurred, 0 otherwise (Censored)
-    df_features['event_status'] = df_features['first_bone_event_date'].notna().astype(int)
+    df_features['event_status'] = df_features['first_bone_event_date'].notna().astype(np.uint8)
 
     return df_features
\ No newline at end of file
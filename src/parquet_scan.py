@@ -0,0 +1,195 @@
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from src.instrument import stage
+
+# Attempts per table in read_tables; only I/O errors other than a missing
+# file (e.g. a network filesystem hiccup) are retried
+READ_ATTEMPTS = 3
+
+
+def _scan_value(value, arrow_type):
+    # Cast a filter value to the column type; None means "can't push this down"
+    if pa.types.is_date(arrow_type) and isinstance(value, pd.Timestamp):
+        value = value.date()
+    try:
+        return pa.scalar(value).cast(arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        return None
+
+
+def _scan_condition(schema, column, op, value):
+    field = pc.field(column)
+    arrow_type = schema.field(column).type
+
+    if op == 'match':
+        return pc.match_substring_regex(field, value, ignore_case=True)
+
+    if op == 'in':
+        try:
+            values = pa.array(value).cast(arrow_type)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+            return None
+        return field.isin(values)
+
+    # Date bounds are only pushed down against temporal columns; string dates
+    # are left to the pandas filters in the consumers
+    if not (pa.types.is_temporal(arrow_type) or pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type)):
+        return None
+    scalar = _scan_value(value, arrow_type)
+    if scalar is None:
+        return None
+    return {
+        '==': field == scalar, '!=': field != scalar,
+        '<': field < scalar, '<=': field <= scalar,
+        '>': field > scalar, '>=': field >= scalar,
+    }[op]
+
+
+def scan_expression(filters, schema):
+    # filters use the pyarrow/dask DNF layout: a list of (column, op, value)
+    # tuples ANDed together, or a list of such lists ORed together.
+    # Conditions that can't be expressed against the file schema are dropped,
+    # so the scan returns a superset and consumers still apply their own filters.
+    if not filters:
+        return None
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+
+    disjuncts = []
+    for conjunction in filters:
+        expr = None
+        for column, op, value in conjunction:
+            cond = _scan_condition(schema, column, op, value)
+            if cond is not None:
+                expr = cond if expr is None else expr & cond
+        if expr is None:
+            return None
+        disjuncts.append(expr)
+
+    expr = disjuncts[0]
+    for d in disjuncts[1:]:
+        expr = expr | d
+    return expr
+
+
+def _fits_int32(column):
+    bounds = pc.min_max(column)
+    low, high = bounds['min'].as_py(), bounds['max'].as_py()
+    return low is None or (low >= -2**31 and high < 2**31)
+
+
+def compact_table(table):
+    # Narrow types before converting to pandas: strings become dictionary
+    # encoded (pandas categoricals), *_id columns int32 when every value fits,
+    # float64 values float32. Dates stay date32 in Arrow; pandas has no
+    # date-only dtype, so they arrive as datetime64.
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+            column = pc.dictionary_encode(column)
+        elif pa.types.is_int64(column.type) and name.endswith('_id') and _fits_int32(column):
+            column = column.cast(pa.int32())
+        elif pa.types.is_float64(column.type):
+            column = column.cast(pa.float32(), safe=False)
+        columns.append(column)
+    return pa.table(columns, names=table.column_names)
+
+
+def scan_table(path, columns=None, filters=None, compact=True):
+    # Projected, filtered scan as an Arrow table
+    with stage(f'read_table {Path(path).stem}') as record:
+        dataset = ds.dataset(path, format='parquet')
+        if columns is not None:
+            columns = [c for c in columns if c in dataset.schema.names]
+        table = dataset.to_table(columns=columns, filter=scan_expression(filters, dataset.schema))
+        if compact:
+            table = compact_table(table)
+        record['rows_out'] = table.num_rows
+        record['bytes'] = table.nbytes
+        return table
+
+
+def read_table(path, columns=None, filters=None, compact=True):
+    return scan_table(path, columns, filters, compact).to_pandas(date_as_object=False)
+
+
+def iter_batches(path, columns=None, filters=None, batch_size=1_000_000, compact=True):
+    # Same scan as read_table, but yields pandas frames one record batch at a time
+    dataset = ds.dataset(path, format='parquet')
+    if columns is not None:
+        columns = [c for c in columns if c in dataset.schema.names]
+    batches = dataset.to_batches(
+        columns=columns, filter=scan_expression(filters, dataset.schema), batch_size=batch_size
+    )
+    for batch in batches:
+        if batch.num_rows:
+            table = pa.Table.from_batches([batch])
+            yield (compact_table(table) if compact else table).to_pandas(date_as_object=False)
+
+
+def _size_on_disk(path):
+    path = Path(path)
+    if path.is_dir():
+        return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+    return path.stat().st_size
+
+
+def require_tables(paths):
+    # Raise one FileNotFoundError naming every missing input ({name: path}),
+    # before anything is read
+    missing = {name: path for name, path in paths.items() if not Path(path).exists()}
+    if missing:
+        listed = '\n'.join(f'  {name}: {path}' for name, path in missing.items())
+        raise FileNotFoundError(
+            f"{len(missing)} input table(s) not found -- check FOLDER_PATH:\n{listed}"
+        )
+
+
+def _read_with_retries(path, columns, filters, compact, as_arrow):
+    # (table, seconds taken)
+    start = time.perf_counter()
+    for attempt in range(1, READ_ATTEMPTS + 1):
+        try:
+            table = scan_table(path, columns, filters, compact)
+            return (table if as_arrow else table.to_pandas(date_as_object=False)), time.perf_counter() - start
+        except FileNotFoundError:
+            raise
+        except OSError:
+            if attempt == READ_ATTEMPTS:
+                raise
+            time.sleep(0.5 * attempt)
+
+
+def read_tables(scans, n_threads=None, compact=True, as_arrow=False):
+    # Read several tables at once: scans is {name: (path, scan)} with scan a
+    # TABLE_SCANS-style {'columns', 'filters'} dict. Scans run on a thread
+    # pool (Arrow releases the GIL while decoding), so the total is bounded
+    # by the largest table rather than the sum. Each table's size on disk,
+    # rows and time are printed as it finishes. Missing files are reported
+    # together before any read starts; a failed read cancels the rest and
+    # raises naming the table. Returns {name: DataFrame} (Arrow tables with
+    # as_arrow=True)
+    require_tables({name: path for name, (path, _) in scans.items()})
+    out = {}
+    with ThreadPoolExecutor(max_workers=n_threads or len(scans) or 1) as pool:
+        futures = {
+            pool.submit(_read_with_retries, path, scan.get('columns'), scan.get('filters'), compact, as_arrow): name
+            for name, (path, scan) in scans.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            path = scans[name][0]
+            try:
+                out[name], seconds = future.result()
+            except Exception as e:
+                for other in futures:
+                    other.cancel()
+                raise RuntimeError(f"Could not read {name} from {path}: {e}") from e
+            rows = out[name].num_rows if as_arrow else len(out[name])
+            print(f'  {name}: {_size_on_disk(path) / 2**20:,.1f} MB on disk, {rows:,} rows in {seconds:.2f}s')
+    return {name: out[name] for name in scans}
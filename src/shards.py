@@ -0,0 +1,48 @@
+import pandas as pd
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from src.instrument import stage
+
+# Every feature is computed from a patient's own rows and reference date, so
+# the cohort can be hash-partitioned by person_id and each shard's event rows
+# processed independently. Results are concatenated; anything cohort-wide
+# (the lab row-count threshold) is applied after the concat.
+
+
+def shard_of(person_ids, n_shards):
+    # Stable hash partition: the same person_id always lands in the same shard
+    hashed = pd.util.hash_array(np.asarray(person_ids, dtype=np.int64))
+    return (hashed % np.uint64(n_shards)).astype(np.int64)
+
+
+def split_shards(df, n_shards):
+    # One frame per shard; rows keep their input order within a shard, so
+    # order-dependent aggregations (first/last on date ties) are unchanged
+    shard = shard_of(df['person_id'], n_shards)
+    order = np.argsort(shard, kind='stable')
+    bounds = np.searchsorted(shard[order], np.arange(n_shards + 1))
+    return [df.iloc[order[bounds[i]:bounds[i + 1]]] for i in range(n_shards)]
+
+
+def map_shards(func, df_cohort, frames, n_jobs, *args, n_shards=None):
+    # func(cohort_shard, *frame_shards, *args) for every non-empty cohort shard
+    # on a process pool of n_jobs workers; returns the per-shard results in
+    # shard order. func must be importable (module level) to be sent to workers.
+    n_shards = n_shards or n_jobs
+    cohort_parts = split_shards(df_cohort, n_shards)
+    frame_parts = [split_shards(df, n_shards) for df in frames]
+    todo = [i for i in range(n_shards) if len(cohort_parts[i])]
+
+    with stage(f'{func.__name__} x{n_shards} shards', rows_in=len(df_cohort) + sum(len(df) for df in frames)) as record:
+        # forkserver, not fork: the parent may be running Arrow or BLAS
+        # threads, whose locks a forked child could inherit held
+        context = multiprocessing.get_context('forkserver')
+        with ProcessPoolExecutor(max_workers=max(1, min(n_jobs, len(todo))), mp_context=context) as pool:
+            futures = [
+                pool.submit(func, cohort_parts[i], *[parts[i] for parts in frame_parts], *args)
+                for i in todo
+            ]
+            results = [future.result() for future in futures]
+        record['rows_out'] = sum(len(r) for r in results)
+    return results
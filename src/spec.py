@@ -0,0 +1,41 @@
+import copy
+import json
+from src.windows import WINDOWS
+from src.add_measurement_features import HIGH_FREQ_LABS, LAB_FEATURES
+from src.add_drug_features import DRUG_CATEGORIES
+
+# Everything a run computes, in one place: prediction horizons (each is an
+# observation window before the reference date, and a model target), the labs
+# and their wide aggregations (see LAB_AGGREGATIONS), the value for patients
+# without a lab in a window (null keeps NaN, which the hgb model handles
+# natively and lr/rf median-impute), the drug categories, and the model types
+# fit for every horizon (see models.common.MODELS). Survival models fit on
+# patients still at risk landmark_days after their first visit (see
+# src/landmark.py).
+#
+# Horizons share one scan per table, and each horizon's lab and drug stages
+# are cached separately, so adding a horizon computes only that horizon.
+SPEC = {
+    'horizons': WINDOWS,
+    'labs': HIGH_FREQ_LABS,
+    'lab_aggregations': LAB_FEATURES,
+    'lab_fill_value': 0,
+    'drug_categories': DRUG_CATEGORIES,
+    'models': ['lr', 'rf'],
+    'landmark_days': 365,
+}
+
+
+def load_spec(path=None):
+    # SPEC, with any top-level keys replaced by those in a JSON file, e.g.
+    # {"horizons": {"3m": {"start_days": 180, "end_days": 90}, "6m": {...}}}
+    spec = copy.deepcopy(SPEC)
+    if path is None:
+        return spec
+    with open(path) as f:
+        overrides = json.load(f)
+    unknown = set(overrides) - set(spec)
+    if unknown:
+        raise ValueError(f"Unknown spec keys {sorted(unknown)} in {path}; expected {sorted(spec)}")
+    spec.update(overrides)
+    return spec
@@ -0,0 +1,175 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+from src.make_dataframe import EVENT_IDS
+from src.add_measurement_features import HIGH_FREQ_LABS
+from src.add_drug_features import BMAS, CHEMOTHERAPY, TARGETED_THERAPY
+
+# Seeded OMOP-shaped parquet extract for benchmarking without the real data.
+# Concept mixes come from the pipeline's own definitions, plus some noise
+# concepts that the filters should throw away.
+
+OTHER_LABS = ["Cholesterol [Mass/volume] in Serum or Plasma", "Hemoglobin A1c/Hemoglobin.total in Blood", "Troponin I.cardiac [Mass/volume] in Serum or Plasma"]
+OTHER_DRUGS = ["acetaminophen 500 MG Oral Tablet", "ondansetron 4 MG Oral Tablet", "ZOLEDRONIC ACID 4 MG/5ML Injection", "oxycodone hydrochloride 5 MG Oral Tablet"]
+FRACTURE_NAMES = ["Bone fracture assessment", "Pathologic fracture of vertebra", "Vertebral fracture evaluation"]
+RADIATION_NAMES = ["Radiation therapy planning", "Radiotherapy to bone", "External beam radiation treatment"]
+OTHER_PROCEDURES = ["Office visit", "CT of chest", "MRI of spine", "Bone scan", "Biopsy of bone", "Venipuncture"]
+
+EVENT_RATE = 0.11
+EVENT_ID_RATE = 0.01
+DEATH_RATE = 0.3
+MIN_SPAN_DAYS, MAX_SPAN_DAYS = 365, 8 * 365
+MEAN_SPAN_DAYS = (MIN_SPAN_DAYS + MAX_SPAN_DAYS) / 2
+
+SCHEMAS = {
+    'person': pa.schema([('person_id', pa.int64()), ('gender_concept_name', pa.string()), ('year_of_birth', pa.int64())]),
+    'death': pa.schema([('person_id', pa.int64()), ('death_date', pa.date32())]),
+    'visit_occurence': pa.schema([
+        ('visit_occurrence_id', pa.int64()), ('person_id', pa.int64()),
+        ('visit_start_date', pa.date32()), ('visit_end_date', pa.date32())
+    ]),
+    'procedure_occurence': pa.schema([
+        ('procedure_occurrence_id', pa.int64()), ('person_id', pa.int64()), ('procedure_concept_id', pa.int64()),
+        ('concept_name', pa.string()), ('procedure_date', pa.date32())
+    ]),
+    'measurement': pa.schema([
+        ('measurement_id', pa.int64()), ('person_id', pa.int64()), ('concept_name', pa.string()),
+        ('measurement_date', pa.date32()), ('value_as_number', pa.float64())
+    ]),
+    'drug_exposure': pa.schema([
+        ('drug_exposure_id', pa.int64()), ('person_id', pa.int64()), ('concept_name', pa.string()),
+        ('drug_exposure_start_date', pa.date32())
+    ]),
+}
+
+
+def _dates(start, span_days, frac):
+    # start + frac * span, as date32 day numbers
+    return (start + (frac * span_days).astype(np.int64)).astype('datetime64[D]')
+
+
+def _events_per_patient(rng, n, mean, span):
+    # Rows recorded at a constant rate over each patient's follow-up (mean
+    # per patient on average), so how densely a stretch of history is filled
+    # says nothing about how long follow-up lasts
+    counts = rng.poisson(mean * span / MEAN_SPAN_DAYS)
+    return counts, np.repeat(np.arange(n), counts)
+
+
+def _chunk(rng, first_id, n, lab_means, scale):
+    person_id = first_id + np.arange(n, dtype=np.int64)
+
+    # Follow-up: start 2010-2018, 1-8 years long
+    start = np.datetime64('2010-01-01', 'D').astype(np.int64) + rng.integers(0, 9 * 365, n)
+    span = rng.integers(MIN_SPAN_DAYS, MAX_SPAN_DAYS, n)
+    end = start + span
+
+    tables = {}
+    tables['person'] = pd.DataFrame({
+        'person_id': person_id,
+        'gender_concept_name': rng.choice(['MALE', 'FEMALE'], n),
+        'year_of_birth': rng.integers(1930, 2000, n),
+    })
+
+    dead = rng.random(n) < DEATH_RATE
+    tables['death'] = pd.DataFrame({'person_id': person_id[dead], 'death_date': end[dead].astype('datetime64[D]')})
+
+    # Visits; the last one ends at the end of follow-up
+    counts, owner = _events_per_patient(rng, n, scale['visits'], span)
+    visit_start = _dates(start[owner], span[owner], rng.random(len(owner)))
+    last = np.cumsum(counts) - 1
+    visit_start[last[counts > 0]] = end[counts > 0].astype('datetime64[D]')
+    tables['visit_occurence'] = pd.DataFrame({
+        'person_id': person_id[owner],
+        'visit_start_date': visit_start,
+        'visit_end_date': visit_start + rng.integers(0, 5, len(owner)).astype('timedelta64[D]'),
+    })
+
+    # Procedures: background mix, plus fracture -> radiation for ~11% of
+    # patients and EVENT_IDS codes for ~1%
+    counts, owner = _events_per_patient(rng, n, scale['procedures'], span)
+    procedures = pd.DataFrame({
+        'person_id': person_id[owner],
+        'procedure_concept_id': rng.integers(2_000_000, 2_100_000, len(owner)),
+        'concept_name': rng.choice(OTHER_PROCEDURES + RADIATION_NAMES, len(owner), p=[0.15] * 6 + [0.1 / 3] * 3),
+        'procedure_date': _dates(start[owner], span[owner], rng.random(len(owner))),
+    })
+    event = np.flatnonzero(rng.random(n) < EVENT_RATE)
+    fracture_date = _dates(start[event], span[event], rng.uniform(0.5, 0.95, len(event)))
+    fractures = pd.DataFrame({
+        'person_id': person_id[event],
+        'procedure_concept_id': rng.integers(2_000_000, 2_100_000, len(event)),
+        'concept_name': rng.choice(FRACTURE_NAMES, len(event)),
+        'procedure_date': fracture_date,
+    })
+    radiation = pd.DataFrame({
+        'person_id': person_id[event],
+        'procedure_concept_id': rng.integers(2_000_000, 2_100_000, len(event)),
+        'concept_name': rng.choice(RADIATION_NAMES, len(event)),
+        'procedure_date': fracture_date + rng.integers(5, 60, len(event)).astype('timedelta64[D]'),
+    })
+    coded = np.flatnonzero(rng.random(n) < EVENT_ID_RATE)
+    event_codes = pd.DataFrame({
+        'person_id': person_id[coded],
+        'procedure_concept_id': rng.choice(EVENT_IDS, len(coded)),
+        'concept_name': 'Bone procedure',
+        'procedure_date': _dates(start[coded], span[coded], rng.random(len(coded))),
+    })
+    procedures = pd.concat([procedures, fractures, radiation, event_codes], ignore_index=True)
+    tables['procedure_occurence'] = procedures
+
+    # Measurements: mostly HIGH_FREQ_LABS (vitals most common), some noise labs, ~2% missing values
+    labs = HIGH_FREQ_LABS + OTHER_LABS
+    weights = np.concatenate([np.linspace(3, 1, len(HIGH_FREQ_LABS)), np.full(len(OTHER_LABS), 0.5)])
+    counts, owner = _events_per_patient(rng, n, scale['measurements'], span)
+    lab = rng.choice(len(labs), len(owner), p=weights / weights.sum())
+    value = rng.normal(lab_means[lab], lab_means[lab] * 0.15)
+    value[rng.random(len(owner)) < 0.02] = np.nan
+    tables['measurement'] = pd.DataFrame({
+        'person_id': person_id[owner],
+        'concept_name': np.asarray(labs, dtype=object)[lab],
+        'measurement_date': _dates(start[owner], span[owner], rng.random(len(owner))),
+        'value_as_number': value,
+    })
+
+    # Drug exposures: cancer drugs at a few percent, the rest background
+    drugs = BMAS + CHEMOTHERAPY + TARGETED_THERAPY + OTHER_DRUGS
+    weights = np.concatenate([np.full(len(drugs) - len(OTHER_DRUGS), 1.0), np.full(len(OTHER_DRUGS), 40.0)])
+    counts, owner = _events_per_patient(rng, n, scale['drugs'], span)
+    tables['drug_exposure'] = pd.DataFrame({
+        'person_id': person_id[owner],
+        'concept_name': rng.choice(np.asarray(drugs, dtype=object), len(owner), p=weights / weights.sum()),
+        'drug_exposure_start_date': _dates(start[owner], span[owner], rng.random(len(owner))),
+    })
+    return tables
+
+
+def generate_omop(out_dir, n_patients=10_000, seed=0, measurements=200, drugs=20, procedures=10, visits=8,
+                  chunk_size=100_000):
+    # Write person, death, visit_occurence, procedure_occurence, measurement and
+    # drug_exposure parquet files for n_patients, in patient chunks so memory
+    # stays bounded at any scale. Per-patient row counts are Poisson, with
+    # these means for a patient of average follow-up.
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    scale = {'measurements': measurements, 'drugs': drugs, 'procedures': procedures, 'visits': visits}
+    lab_means = rng.lognormal(3, 1.5, len(HIGH_FREQ_LABS) + len(OTHER_LABS))
+
+    writers = {name: pq.ParquetWriter(out_dir / f'{name}.parquet', schema) for name, schema in SCHEMAS.items()}
+    rows = {name: 0 for name in SCHEMAS}
+    try:
+        for first in range(0, n_patients, chunk_size):
+            n = min(chunk_size, n_patients - first)
+            for name, df in _chunk(rng, first + 1, n, lab_means, scale).items():
+                id_col = SCHEMAS[name].names[0]
+                if id_col != 'person_id':
+                    df.insert(0, id_col, np.arange(rows[name], rows[name] + len(df), dtype=np.int64))
+                writers[name].write_table(pa.Table.from_pandas(df, schema=SCHEMAS[name], preserve_index=False))
+                rows[name] += len(df)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return rows
@@ -0,0 +1,85 @@
+import pandas as pd
+import numpy as np
+
+# Observation windows before the reference date (event date or censor date).
+# 6m: 8-4 months before, 12m: 15-9 months before
+WINDOWS = {
+    '6m': {'start_days': 270, 'end_days': 120},
+    '12m': {'start_days': 540, 'end_days': 180}
+}
+
+
+def reference_dates(df_features):
+    return pd.to_datetime(df_features['first_bone_event_date'].fillna(df_features['last_of_death_or_visit']))
+
+
+def window_date_range(df_features, windows=WINDOWS):
+    # Earliest window start and latest window end over the cohort, for scan filters
+    ref_date = reference_dates(df_features)
+    start_days = max(days['start_days'] for days in windows.values())
+    end_days = min(days['end_days'] for days in windows.values())
+    return ref_date.min() - pd.Timedelta(days=start_days), ref_date.max() - pd.Timedelta(days=end_days)
+
+
+def window_positions(person_ids, event_dates, df_features, windows=WINDOWS):
+    # Which patient windows each event falls in (bounds inclusive), as
+    # (rows, persons, window codes): positions into the events, positions of
+    # their patients in df_features and window positions in windows, one
+    # entry per (event, window) match.
+    #
+    # Instead of merging windows onto every event and filtering, events are
+    # sorted once by (person, date) and each (person, window) range is found
+    # with two searchsorted calls, so the cost is one sort plus output size
+    # no matter how many windows are requested. Within a window, rows come out
+    # ordered by person then date, ties kept in input order.
+    persons = pd.Index(df_features['person_id'])
+    ref_date = reference_dates(df_features).to_numpy()
+
+    event_dates = np.asarray(event_dates)
+    codes = persons.get_indexer(person_ids)
+    keep = np.flatnonzero((codes >= 0) & ~np.isnat(event_dates))
+    codes, event_dates = codes[keep], event_dates[keep]
+
+    bounds = {
+        suffix: (ref_date - np.timedelta64(days['start_days'], 'D'), ref_date - np.timedelta64(days['end_days'], 'D'))
+        for suffix, days in windows.items()
+    }
+
+    # Dense-rank all timestamps together so (person, date) packs into one int64 key
+    all_dates = np.concatenate([event_dates] + [b for pair in bounds.values() for b in pair])
+    all_dates = all_dates[~np.isnat(all_dates)]
+    uniques = np.unique(all_dates)
+    span = len(uniques) + 1
+
+    key = codes.astype(np.int64) * span + np.searchsorted(uniques, event_dates)
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+
+    person_codes = np.arange(len(persons), dtype=np.int64) * span
+    pieces, owners, labels = [], [], []
+    for i, (win_start, win_end) in enumerate(bounds.values()):
+        valid = ~(np.isnat(win_start) | np.isnat(win_end))
+        lo = np.searchsorted(sorted_key, person_codes + np.searchsorted(uniques, win_start), side='left')
+        hi = np.searchsorted(sorted_key, person_codes + np.searchsorted(uniques, win_end), side='right')
+        n = np.where(valid, np.maximum(hi - lo, 0), 0)
+
+        # Expand [lo, hi) ranges into flat row positions
+        offsets = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        pieces.append(order[np.repeat(lo, n) + offsets])
+        owners.append(np.repeat(np.arange(len(persons)), n))
+        labels.append(np.full(n.sum(), i, dtype=np.int8))
+
+    if not pieces:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.int8)
+    return keep[np.concatenate(pieces)], np.concatenate(owners), np.concatenate(labels)
+
+
+def join_windows(df_events, df_features, date_col, windows=WINDOWS):
+    # Map each event row to every patient window it falls in (bounds
+    # inclusive) and return those rows tagged with a categorical 'window'
+    # column, in window_positions' order
+    event_dates = pd.to_datetime(df_events[date_col]).to_numpy()
+    rows, _, labels = window_positions(df_events['person_id'], event_dates, df_features, windows)
+    df_joined = df_events.iloc[rows].reset_index(drop=True)
+    df_joined['window'] = pd.Categorical.from_codes(labels, categories=list(windows))
+    return df_joined
@@ -0,0 +1,13 @@
+from src.synthetic_data import generate_omop
+from src.load_data import load_data
+from src.arrow_backend import mismatched_columns
+
+
+def test_arrow_backend_matches_pandas(tmp_path):
+    folder = tmp_path / "omop"
+    generate_omop(folder, n_patients=300, measurements=60, drugs=10, seed=5)
+    df_pandas = load_data(str(folder), backend='pandas')
+    df_arrow = load_data(str(folder), backend='arrow')
+
+    assert len(df_pandas)
+    assert mismatched_columns(df_pandas, df_arrow) == []
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+from src.add_measurement_features import lab_first_last, lab_feature_block, lab_feature_sparse, safe_lab_name
+from src.windows import WINDOWS
+
+LABS = ["Heart rate", "Body weight"]
+# 'count' first: it must not change what mean, std and slope see
+AGGREGATIONS = ["count", "mean", "std", "slope", "first", "last", "min", "max", "delta", "days_since_last"]
+
+
+def _data(seed=0, n_patients=30):
+    rng = np.random.default_rng(seed)
+    ref = pd.Timestamp("2023-06-01") + pd.to_timedelta(rng.integers(0, 200, n_patients), unit="D")
+    df_features = pd.DataFrame({
+        "person_id": np.arange(1, n_patients + 1),
+        "first_bone_event_date": ref.where(rng.random(n_patients) < 0.3),
+        "last_of_death_or_visit": ref,
+    })
+    n_rows = 1500
+    person = rng.integers(1, n_patients + 1, n_rows)
+    days_before = rng.integers(0, 600, n_rows)
+    value = rng.normal(60, 15, n_rows).round(1)
+    value[rng.random(n_rows) < 0.25] = np.nan
+    df_measurements = pd.DataFrame({
+        "person_id": person,
+        "concept_name": rng.choice(LABS, n_rows),
+        "measurement_date": ref[person - 1] - pd.to_timedelta(days_before, unit="D"),
+        "value_as_number": value,
+    })
+    return df_features, df_measurements
+
+
+def _brute_force(df_features, df_measurements):
+    # Every aggregation for every patient, lab and window, one at a time
+    expected = {}
+    ref_dates = df_features.set_index("person_id")["last_of_death_or_visit"]
+    for lab in LABS:
+        for suffix, days in WINDOWS.items():
+            for person_id, ref in ref_dates.items():
+                start, end = ref - pd.Timedelta(days=days["start_days"]), ref - pd.Timedelta(days=days["end_days"])
+                rows = df_measurements[
+                    (df_measurements["person_id"] == person_id) & (df_measurements["concept_name"] == lab)
+                    & df_measurements["measurement_date"].between(start, end)
+                ].sort_values("measurement_date", kind="stable")
+                valid = rows[rows["value_as_number"].notna()]
+                v = valid["value_as_number"].to_numpy()
+                t = ((valid["measurement_date"] - ref) / pd.Timedelta(days=1)).to_numpy()
+                n = len(rows)
+                stats = {
+                    "count": n if n else np.nan,
+                    "mean": v.mean() if len(v) else np.nan,
+                    "std": v.std(ddof=1) if len(v) > 1 else np.nan,
+                    "slope": np.polyfit(t, v, 1)[0] if len(np.unique(t)) > 1 else np.nan,
+                    "first": v[0] if len(v) else np.nan,
+                    "last": v[-1] if len(v) else np.nan,
+                    "min": v.min() if len(v) else np.nan,
+                    "max": v.max() if len(v) else np.nan,
+                    "delta": v[-1] - v[0] if len(v) else np.nan,
+                    "days_since_last": -t.max() if len(v) else np.nan,
+                }
+                for agg in AGGREGATIONS:
+                    expected.setdefault(f"{safe_lab_name(lab)}_{agg}_{suffix}", {})[person_id] = stats[agg]
+    return pd.DataFrame(expected).reindex(df_features["person_id"])
+
+
+def test_lab_aggregations_match_brute_force():
+    df_features, df_measurements = _data()
+    df_features["first_bone_event_date"] = pd.NaT  # reference date is last_of_death_or_visit
+    lab_stats = lab_first_last(df_features, df_measurements.copy(), WINDOWS, LABS)
+    block = lab_feature_block(df_features["person_id"], lab_stats, WINDOWS, LABS, AGGREGATIONS, fill_value=None, min_rows=1)
+    expected = _brute_force(df_features, df_measurements)
+
+    assert sorted(block.columns) == sorted(expected.columns)
+    for column in expected.columns:
+        np.testing.assert_allclose(
+            block[column].to_numpy(dtype=float), expected[column].to_numpy(dtype=float),
+            rtol=1e-6, atol=1e-6, equal_nan=True, err_msg=column
+        )
+
+
+def test_aggregation_order_does_not_matter():
+    df_features, df_measurements = _data(seed=1)
+    lab_stats = lab_first_last(df_features, df_measurements, WINDOWS, LABS)
+    args = (df_features["person_id"], lab_stats, WINDOWS, LABS)
+    forward = lab_feature_block(*args, AGGREGATIONS, fill_value=None, min_rows=1)
+    backward = lab_feature_block(*args, AGGREGATIONS[::-1], fill_value=None, min_rows=1)
+    pd.testing.assert_frame_equal(forward, backward[forward.columns])
+
+
+def test_sparse_block_matches_dense():
+    df_features, df_measurements = _data(seed=2)
+    lab_stats = lab_first_last(df_features, df_measurements, WINDOWS, LABS)
+    dense = lab_feature_block(df_features["person_id"], lab_stats, WINDOWS, LABS, AGGREGATIONS, fill_value=None)
+    block = lab_feature_sparse(df_features["person_id"], lab_stats, WINDOWS, LABS, AGGREGATIONS)
+    assert block["columns"] == list(dense.columns)
+    values = block["values"].toarray().astype(float)
+    values[~block["observed"].toarray()] = np.nan
+    np.testing.assert_allclose(values, dense.to_numpy(dtype=float), rtol=1e-5, equal_nan=True)
@@ -0,0 +1,26 @@
+import pandas as pd
+from src.synthetic_data import generate_omop
+from src.load_data import load_data
+from src.landmark import landmark_table, landmark_dates
+from src.spec import SPEC
+
+
+def test_landmark_features_use_only_rows_before_the_landmark(tmp_path):
+    folder = tmp_path / "omop"
+    generate_omop(folder, n_patients=300, measurements=60, drugs=10, seed=3)
+    df_features = load_data(str(folder))
+    df_landmark = landmark_table(str(folder), df_features)
+
+    assert list(df_landmark.columns) == list(df_features.columns) + ["landmark_date", "follow_up_days"]
+    assert len(df_landmark) and (df_landmark["follow_up_days"] > 0).all()
+
+    # Dropping every lab and drug row from the landmark on changes nothing
+    landmark = landmark_dates(df_features, SPEC["landmark_days"]).set_axis(df_features["person_id"])
+    truncated = tmp_path / "truncated"
+    truncated.mkdir()
+    for name, date_col in [("measurement", "measurement_date"), ("drug_exposure", "drug_exposure_start_date")]:
+        df = pd.read_parquet(folder / f"{name}.parquet")
+        before = pd.to_datetime(df[date_col]) < df["person_id"].map(landmark)
+        df[before.to_numpy()].to_parquet(truncated / f"{name}.parquet", index=False)
+
+    pd.testing.assert_frame_equal(landmark_table(str(truncated), df_features), df_landmark)